@@ -0,0 +1,37 @@
+from datetime import datetime, timedelta, timezone
+
+from aiohttp import web
+
+
+class FakeCloud:
+    """IAM, compute metadata and resource manager endpoints of Yandex Cloud."""
+
+    def __init__(self, clouds: int = 1, folders_per_cloud: int = 1) -> None:
+        self.clouds = clouds
+        self.folders_per_cloud = folders_per_cloud
+        self.iam_requests = 0
+        self.app = web.Application()
+        self.app.router.add_post('/iam/v1/tokens', self.create_iam_token)
+        self.app.router.add_get('/computeMetadata/v1/instance/service-accounts/default/token', self.metadata_token)
+        self.app.router.add_get('/resource-manager/v1/clouds', self.list_clouds)
+        self.app.router.add_get('/resource-manager/v1/folders', self.list_folders)
+
+    async def create_iam_token(self, request: web.Request) -> web.Response:
+        self.iam_requests += 1
+        expires_at = datetime.now(timezone.utc) + timedelta(hours=12)
+        return web.json_response({'iamToken': f'iam-{self.iam_requests}', 'expiresAt': expires_at.isoformat()})
+
+    async def metadata_token(self, request: web.Request) -> web.Response:
+        self.iam_requests += 1
+        return web.json_response({
+            'access_token': f'iam-{self.iam_requests}', 'expires_in': 43200, 'token_type': 'Bearer',
+        })
+
+    async def list_clouds(self, request: web.Request) -> web.Response:
+        return web.json_response({'clouds': [{'id': f'cloud{i}', 'name': f'Cloud {i}'} for i in range(self.clouds)]})
+
+    async def list_folders(self, request: web.Request) -> web.Response:
+        cloud_id = request.query['cloudId']
+        return web.json_response({'folders': [
+            {'id': f'{cloud_id}-folder{i}', 'name': f'Folder {i}'} for i in range(self.folders_per_cloud)
+        ]})
@@ -0,0 +1,84 @@
+import asyncio
+import random
+
+import grpc
+
+from yandex.cloud.ai.stt.v3 import stt_pb2, stt_service_pb2_grpc
+
+TRANSCRIPT_WORD = 'transcript'
+
+
+class FakeRecognizer(stt_service_pb2_grpc.RecognizerServicer):
+    """Recognizer emitting a final utterance for every ``utterance_bytes`` of audio received.
+
+    Each utterance is delayed by ``latency`` seconds. With ``error_rate`` calls fail with UNAVAILABLE after the audio
+    was received, ``error_code`` changes the status. With ``abort_rate`` calls fail the same way right after their
+    first utterance, in the middle of the stream. With ``slow_rate`` calls hold their first response back for
+    ``slow_delay`` seconds, as a call stuck on an overloaded node would.
+    """
+
+    def __init__(self, latency: float = 0.0, utterance_bytes: int = 16000, partials: bool = False,
+                 error_rate: float = 0.0, error_code: grpc.StatusCode = grpc.StatusCode.UNAVAILABLE,
+                 abort_rate: float = 0.0, slow_rate: float = 0.0, slow_delay: float = 5.0) -> None:
+        self.latency = latency
+        self.utterance_bytes = utterance_bytes
+        self.partials = partials
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.abort_rate = abort_rate
+        self.slow_rate = slow_rate
+        self.slow_delay = slow_delay
+        self.calls = 0
+        self.bytes_received = 0
+
+    async def RecognizeStreaming(self, request_iterator, context):  # type: ignore
+        self.calls += 1
+        fail = random.random() < self.error_rate
+        abort = random.random() < self.abort_rate
+        delay = self.slow_delay if random.random() < self.slow_rate else 0.0
+        received = 0
+        utterances = 0
+        async for request in request_iterator:
+            if not request.HasField('chunk'):
+                continue
+            received += len(request.chunk.data)
+            self.bytes_received += len(request.chunk.data)
+            if fail:
+                continue
+            if delay:
+                await asyncio.sleep(delay)
+                delay = 0.0
+            if self.partials:
+                yield self.__partial(utterances)
+            while received >= (utterances + 1) * self.utterance_bytes:
+                utterances += 1
+                await asyncio.sleep(self.latency)
+                yield self.__final(utterances)
+                if abort:
+                    await context.abort(self.error_code, 'Injected abort')
+        if fail:
+            await context.abort(self.error_code, 'Injected fault')
+        await asyncio.sleep(delay + self.latency)
+        yield self.__final(utterances + 1)
+
+    @staticmethod
+    def __partial(index: int) -> stt_pb2.StreamingResponse:
+        return stt_pb2.StreamingResponse(partial=stt_pb2.AlternativeUpdate(
+            alternatives=[stt_pb2.Alternative(text=f'{TRANSCRIPT_WORD}{index}')],
+        ))
+
+    @staticmethod
+    def __final(index: int) -> stt_pb2.StreamingResponse:
+        return stt_pb2.StreamingResponse(final_refinement=stt_pb2.FinalRefinement(
+            normalized_text=stt_pb2.AlternativeUpdate(
+                alternatives=[stt_pb2.Alternative(text=f'{TRANSCRIPT_WORD}{index}')],
+            ),
+        ))
+
+
+async def start_fake_recognizer(recognizer: FakeRecognizer, host: str = '127.0.0.1') -> tuple[grpc.aio.Server, str]:
+    server = grpc.aio.server()
+    stt_service_pb2_grpc.add_RecognizerServicer_to_server(recognizer, server)
+    port = server.add_insecure_port(f'{host}:0')
+    await server.start()
+    return server, f'{host}:{port}'
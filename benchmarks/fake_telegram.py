@@ -0,0 +1,131 @@
+import asyncio
+import itertools
+import time
+from typing import Any, Optional
+
+from aiohttp import web
+
+from benchmarks.fake_recognizer import TRANSCRIPT_WORD
+
+QUEUED_PREFIX = 'В очереди'
+PROGRESS_SUFFIX = '…'
+DOWNLOAD_CHUNK_SIZE = 16384
+
+
+class FakeTelegram:
+    """Bot API serving voice messages to the bot and recording its replies.
+
+    Messages pushed with ``push_voice`` are returned by getUpdates, their files are generated on the fly by the file
+    endpoint at ``download_rate`` bytes per second (unlimited when zero). A message is completed by the first reply
+    or edit which is not a queue position or a progressive update.
+    """
+
+    def __init__(self, file_size: int = 32000, download_rate: float = 0) -> None:
+        self.file_size = file_size
+        self.download_rate = download_rate
+        self.sent_at: dict[int, float] = {}
+        self.completed_at: dict[int, float] = {}
+        self.errors: dict[int, str] = {}
+        self.all_completed = asyncio.Event()
+        self.__updates: asyncio.Queue[dict[str, Any]] = asyncio.Queue()
+        self.__ids = itertools.count(1)
+        self.__replies: dict[int, int] = {}
+        self.app = web.Application()
+        self.app.router.add_route('*', '/bot{token}/{method}', self.handle_method)
+        self.app.router.add_get('/file/bot{token}/{path:.+}', self.handle_file)
+
+    def push_voice(self, chat_id: int, user_id: int, duration: int = 5) -> int:
+        message_id = next(self.__ids)
+        self.sent_at[message_id] = time.perf_counter()
+        self.all_completed.clear()
+        self.__updates.put_nowait({
+            'update_id': message_id,
+            'message': {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'group', 'title': f'Chat {chat_id}'},
+                'from': {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}'},
+                'voice': {
+                    'file_id': f'file{message_id}',
+                    'file_unique_id': f'unique{message_id}',
+                    'duration': duration,
+                    'mime_type': 'audio/ogg',
+                    'file_size': self.file_size,
+                },
+            },
+        })
+        return message_id
+
+    async def handle_method(self, request: web.Request) -> web.Response:
+        method = request.match_info['method'].lower()
+        params = dict(await request.post())
+        if method == 'getupdates':
+            return self.__ok(await self.__get_updates(float(params.get('timeout') or 0)))
+        if method == 'getfile':
+            file_id = params['file_id']
+            return self.__ok({
+                'file_id': file_id,
+                'file_unique_id': f'unique-{file_id}',
+                'file_size': self.file_size,
+                'file_path': f'voice/{file_id}.oga',
+            })
+        if method == 'sendmessage':
+            reply_to = int(params['reply_to_message_id']) if params.get('reply_to_message_id') else None
+            message = self.__message(int(params['chat_id']), str(params['text']))
+            if reply_to is not None:
+                self.__replies[message['message_id']] = reply_to
+                self.__record(reply_to, str(params['text']))
+            return self.__ok(message)
+        if method == 'editmessagetext':
+            message = self.__message(int(params['chat_id']), str(params['text']), int(params['message_id']))
+            reply_to = self.__replies.get(message['message_id'])
+            if reply_to is not None:
+                self.__record(reply_to, str(params['text']))
+            return self.__ok(message)
+        return self.__ok(True)
+
+    async def handle_file(self, request: web.Request) -> web.StreamResponse:
+        response = web.StreamResponse(headers={'Content-Length': str(self.file_size)})
+        await response.prepare(request)
+        sent = 0
+        while sent < self.file_size:
+            chunk = min(DOWNLOAD_CHUNK_SIZE, self.file_size - sent)
+            await response.write(b'\0' * chunk)
+            sent += chunk
+            if self.download_rate:
+                await asyncio.sleep(chunk / self.download_rate)
+        await response.write_eof()
+        return response
+
+    async def __get_updates(self, timeout: float) -> list[dict[str, Any]]:
+        updates: list[dict[str, Any]] = []
+        if self.__updates.empty() and timeout <= 0:
+            return updates
+        try:
+            updates.append(await asyncio.wait_for(self.__updates.get(), timeout))
+        except asyncio.TimeoutError:
+            return updates
+        while not self.__updates.empty():
+            updates.append(self.__updates.get_nowait())
+        return updates
+
+    def __record(self, message_id: int, text: str) -> None:
+        if message_id in self.completed_at or text.startswith(QUEUED_PREFIX) or text.endswith(PROGRESS_SUFFIX):
+            return
+        self.completed_at[message_id] = time.perf_counter()
+        if not text.startswith(TRANSCRIPT_WORD):
+            self.errors[message_id] = text
+        if len(self.completed_at) == len(self.sent_at):
+            self.all_completed.set()
+
+    def __message(self, chat_id: int, text: str, message_id: Optional[int] = None) -> dict[str, Any]:
+        return {
+            'message_id': message_id or next(self.__ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'group', 'title': f'Chat {chat_id}'},
+            'text': text,
+        }
+
+    @staticmethod
+    def __ok(result: Any) -> web.Response:
+        return web.json_response({'ok': True, 'result': result})
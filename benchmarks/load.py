@@ -0,0 +1,160 @@
+"""Offline load test of the bot handlers and YcStt.
+
+Starts fake Telegram Bot API, Yandex Cloud and SpeechKit Recognizer servers in this process, points the bot at
+them and replays voice messages from several chats concurrently. Reports throughput, latency percentiles and peak
+RSS of the process (fakes generate audio on the fly and keep no copies of it).
+
+    poetry run python -m benchmarks.load --messages 500 --chats 20 --latency 0.05
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import statistics
+import time
+from collections import Counter
+from typing import Any
+
+from aiohttp import web
+
+from benchmarks.fake_cloud import FakeCloud
+from benchmarks.fake_recognizer import FakeRecognizer, start_fake_recognizer
+from benchmarks.fake_telegram import FakeTelegram
+
+BOT_TOKEN = '123456:benchmark'
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=200, help='voice messages to send')
+    parser.add_argument('--chats', type=int, default=10, help='chats the messages are spread over')
+    parser.add_argument('--rate', type=float, default=0, help='messages per second, all at once when zero')
+    parser.add_argument('--file-size', type=int, default=32000, help='size of each voice file in bytes')
+    parser.add_argument('--duration', type=int, default=5, help='reported duration of each voice message')
+    parser.add_argument('--download-rate', type=float, default=0, help='file download speed in bytes per second')
+    parser.add_argument('--latency', type=float, default=0.05, help='recognizer delay per utterance in seconds')
+    parser.add_argument('--utterance-bytes', type=int, default=16000, help='audio bytes per recognized utterance')
+    parser.add_argument('--partials', action='store_true', help='recognizer sends partial results')
+    parser.add_argument('--error-rate', type=float, default=0, help='share of recognizer calls failing')
+    parser.add_argument('--abort-rate', type=float, default=0,
+                        help='share of recognizer calls aborted after their first utterance')
+    parser.add_argument('--slow-rate', type=float, default=0,
+                        help='share of recognizer calls with a delayed first response')
+    parser.add_argument('--slow-delay', type=float, default=5, help='first response delay of slow calls in seconds')
+    parser.add_argument('--timeout', type=float, default=300, help='seconds to wait for all replies')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    return parser.parse_args()
+
+
+async def start_site(app: web.Application) -> tuple[web.AppRunner, str]:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f'http://127.0.0.1:{port}'
+
+
+def percentile(values: list[float], percent: int) -> float:
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100, method='inclusive')[percent - 1]
+
+
+async def run_benchmark(args: argparse.Namespace) -> dict[str, Any]:
+    telegram = FakeTelegram(file_size=args.file_size, download_rate=args.download_rate)
+    cloud = FakeCloud()
+    recognizer = FakeRecognizer(
+        latency=args.latency,
+        utterance_bytes=args.utterance_bytes,
+        partials=args.partials,
+        error_rate=args.error_rate,
+        abort_rate=args.abort_rate,
+        slow_rate=args.slow_rate,
+        slow_delay=args.slow_delay,
+    )
+    telegram_runner, telegram_url = await start_site(telegram.app)
+    cloud_runner, cloud_url = await start_site(cloud.app)
+    recognizer_server, recognizer_target = await start_fake_recognizer(recognizer)
+
+    for name, value in {
+        'API_TOKEN': BOT_TOKEN,
+        'LOG_LEVEL': 'WARNING',
+        'TELEGRAM_API_SERVER': telegram_url,
+        'YC_OAUTH_TOKEN': 'benchmark',
+        'YC_FOLDER_ID': 'benchmark',
+        'YC_ENDPOINTS__IAM_TOKENS': f'{cloud_url}/iam/v1/tokens',
+        'YC_ENDPOINTS__RESOURCE_MANAGER': f'{cloud_url}/resource-manager/v1',
+        'SPEECHKIT__ENDPOINT': recognizer_target,
+        'SPEECHKIT__SECURE': 'false',
+        'TRANSCRIPT_CACHE__ENABLED': 'false',
+    }.items():
+        os.environ.setdefault(name, value)
+
+    # settings are read on import, so the bot is imported only after the environment is ready
+    from aiogram.contrib.fsm_storage.memory import MemoryStorage
+
+    from vmtt_bot import app
+
+    dp = app.create_app()
+    dp.storage = MemoryStorage()
+    chat_ids = [-1000 - index for index in range(args.chats)]
+    for chat_id in chat_ids:
+        await dp.storage.set_state(chat=chat_id, user=chat_id, state=app.AuthStates.authorized.state)
+    await app.on_startup(dp)
+    polling = asyncio.create_task(dp.start_polling(reset_webhook=False))
+
+    started_at = time.perf_counter()
+    try:
+        for index in range(args.messages):
+            chat_id = chat_ids[index % len(chat_ids)]
+            telegram.push_voice(chat_id, chat_id, args.duration)
+            if args.rate:
+                await asyncio.sleep(1 / args.rate)
+        await asyncio.wait_for(telegram.all_completed.wait(), args.timeout)
+    except asyncio.TimeoutError:
+        pass
+    elapsed = time.perf_counter() - started_at
+
+    polling.cancel()
+    await asyncio.gather(polling, return_exceptions=True)
+    await app.on_shutdown(dp)
+    session = await app.bot.get_session()
+    await session.close()
+    await recognizer_server.stop(None)
+    await cloud_runner.cleanup()
+    await telegram_runner.cleanup()
+
+    latencies = sorted(
+        completed_at - telegram.sent_at[message_id]
+        for message_id, completed_at in telegram.completed_at.items()
+        if message_id not in telegram.errors
+    )
+    return {
+        'messages': args.messages,
+        'completed': len(telegram.completed_at),
+        'errors': dict(Counter(telegram.errors.values()).most_common(5)),
+        'elapsed_s': round(elapsed, 3),
+        'throughput_msg_s': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        'latency_p50_s': round(percentile(latencies, 50), 4),
+        'latency_p95_s': round(percentile(latencies, 95), 4),
+        'latency_p99_s': round(percentile(latencies, 99), 4),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'recognizer_calls': recognizer.calls,
+        'iam_requests': cloud.iam_requests,
+    }
+
+
+def main() -> None:
+    args = parse_args()
+    report = asyncio.run(run_benchmark(args))
+    if args.json:
+        print(json.dumps(report))
+        return
+    for name, value in report.items():
+        print(f'{name:>18}: {value}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,407 @@
+import asyncio
+import logging
+import signal
+import time
+from collections.abc import AsyncIterator
+from typing import Optional
+
+import aioredis
+from aiogram import Bot, Dispatcher, types
+from aiohttp import web
+from aiogram.bot.api import TELEGRAM_PRODUCTION, TelegramAPIServer
+from aiogram.contrib.fsm_storage.redis import RedisStorage2
+from aiogram.dispatcher import FSMContext
+from aiogram.dispatcher.filters.state import State, StatesGroup
+from aiogram.utils.deep_linking import decode_payload
+
+from vmtt_bot import metrics
+from vmtt_bot.chat_state import ChatCredentials, ChatStateCache
+from vmtt_bot.jobs import Job, JobQueue, JobWorker
+from vmtt_bot.long_audio import recognize_segments, split_mp3, split_pcm
+from vmtt_bot.preprocessing import AudioPreprocessor
+from vmtt_bot.progress import ProgressiveReply
+from vmtt_bot.scheduler import QueueFull, RecognitionScheduler
+from vmtt_bot.settings import Metrics, settings
+from vmtt_bot.startup import profile
+from vmtt_bot.transcript_cache import TranscriptCache
+from vmtt_bot.yc_stt import RecognitionError, YcStt
+
+bot: Optional[Bot] = None
+dp: Optional[Dispatcher] = None
+redis: Optional[aioredis.Redis] = None
+chat_state: Optional[ChatStateCache] = None
+scheduler: Optional[RecognitionScheduler] = None
+transcript_cache: Optional[TranscriptCache] = None
+job_queue: Optional[JobQueue] = None
+preprocessor: Optional[AudioPreprocessor] = None
+yc_stt: Optional[YcStt] = None
+metrics_runner: Optional[web.AppRunner] = None
+
+
+class AuthStates(StatesGroup):
+    welcome = State()
+    wait_code = State()
+    authorized = State()
+
+
+async def iter_file(bot: Bot, file_path: str, chunk_size: int) -> AsyncIterator[bytes]:
+    session = await bot.get_session()
+    # only the time spent waiting for the network counts, not the time the consumer holds a chunk
+    duration = 0.0
+    started_at = time.perf_counter()
+    try:
+        async with session.get(
+            bot.get_file_url(file_path),
+            proxy=bot.proxy,
+            proxy_auth=bot.proxy_auth,
+            raise_for_status=True,
+        ) as response:
+            duration += time.perf_counter() - started_at
+            while True:
+                started_at = time.perf_counter()
+                chunk = await response.content.read(chunk_size)
+                duration += time.perf_counter() - started_at
+                if not chunk:
+                    break
+                yield chunk
+    finally:
+        metrics.STAGE_DURATION.observe(duration, 'download')
+
+
+async def recognize_progressively(audio_chunks: AsyncIterator[bytes], audio: bool,
+                                  progressive_reply: ProgressiveReply, yc_oauth_token: Optional[str],
+                                  yc_folder_id: Optional[str]) -> str:
+    audio_format = None
+    if preprocessor:
+        audio_chunks = preprocessor.process(audio_chunks, settings.speechkit.chunk_size)
+        audio_format = preprocessor.audio_format
+    parts: list[str] = []
+    async for update in yc_stt.recognize_stream(audio_chunks, audio, yc_oauth_token, yc_folder_id,
+                                                partials=settings.progress.partials, audio_format=audio_format):
+        if update.final:
+            parts.append(update.text)
+            await progressive_reply.update(' '.join(parts))
+        else:
+            await progressive_reply.update(' '.join([*parts, update.text]))
+    return ' '.join(parts)
+
+
+async def recognize_long_audio(audio_chunks: AsyncIterator[bytes], chat_id: int, progressive_reply: ProgressiveReply,
+                               yc_oauth_token: Optional[str], yc_folder_id: Optional[str]) -> str:
+    audio_format = None
+    # only PCM can be cut at any point, other preprocessed audio is split as the original MP3
+    if preprocessor and settings.preprocessing.encoding == 'linear16':
+        audio_chunks = preprocessor.process(audio_chunks, settings.speechkit.chunk_size)
+        audio_format = preprocessor.audio_format
+    data = b''.join([chunk async for chunk in audio_chunks])
+    if audio_format:
+        segments = split_pcm(data, settings.preprocessing.sample_rate, settings.long_audio.segment_duration,
+                             settings.long_audio.overlap)
+    else:
+        segments = split_mp3(data, settings.long_audio.segment_duration, settings.long_audio.overlap)
+    text = ''
+    async for text in recognize_segments(yc_stt, segments, settings.long_audio.concurrency,
+                                         settings.speechkit.chunk_size, settings.long_audio.max_overlap_words,
+                                         yc_oauth_token, yc_folder_id, audio_format,
+                                         lambda: scheduler.enqueue(chat_id, yc_folder_id or settings.yc_folder_id)):
+        await progressive_reply.update(text)
+    return text
+
+
+def get_recognition_options(audio: bool, long_audio: bool) -> str:
+    """Describe the audio sent to SpeechKit, transcripts are cached per file and these options."""
+    options = 'mp3' if audio else 'ogg_opus'
+    preprocessing = settings.preprocessing
+    # long audio is preprocessed only as PCM, see recognize_long_audio
+    if preprocessor and (not long_audio or preprocessing.encoding == 'linear16'):
+        options += f':{preprocessing.encoding}:{preprocessing.sample_rate}'
+        if preprocessing.encoding == 'ogg_opus':
+            options += f':{preprocessing.opus_bitrate}'
+        if preprocessing.trim_silence:
+            options += f':trim{preprocessing.silence_threshold}'
+    return options
+
+
+async def recognize_message(message: types.Message, audio: bool, yc_oauth_token: Optional[str],
+                            yc_folder_id: Optional[str]) -> None:
+    media = message.audio if audio else message.voice
+    long_audio = audio and settings.long_audio.enabled and media.duration >= settings.long_audio.min_duration
+    options = get_recognition_options(audio, long_audio)
+    if transcript_cache:
+        text = await transcript_cache.get(media.file_unique_id, options)
+        metrics.TRANSCRIPT_CACHE_REQUESTS.inc('miss' if text is None else 'hit')
+        if text is not None:
+            await message.reply(text)
+            return
+    try:
+        ticket = scheduler.enqueue(message.chat.id, yc_folder_id or settings.yc_folder_id)
+    except QueueFull:
+        await message.reply('Слишком много сообщений в очереди, попробуйте позже')
+        return
+    if ticket.position:
+        try:
+            await message.reply(f'В очереди, позиция {ticket.position}')
+        except Exception:
+            scheduler.cancel(ticket)
+            raise
+    progressive_reply = ProgressiveReply(
+        message,
+        settings.progress.edit_interval,
+        progressive=media.duration >= settings.progress.min_duration,
+    )
+    queued_at = time.perf_counter()
+    async with ticket:
+        metrics.STAGE_DURATION.observe(time.perf_counter() - queued_at, 'queue')
+        await message.answer_chat_action('typing')
+        file = await media.get_file()
+        audio_chunks = iter_file(message.bot, file.file_path, settings.speechkit.chunk_size)
+        try:
+            if long_audio:
+                text = await recognize_long_audio(audio_chunks, message.chat.id, progressive_reply,
+                                                  yc_oauth_token, yc_folder_id)
+            else:
+                text = await recognize_progressively(audio_chunks, audio, progressive_reply, yc_oauth_token,
+                                                     yc_folder_id)
+        except RecognitionError as exc:
+            await message.reply(str(exc))
+            return
+    if transcript_cache:
+        await transcript_cache.set(media.file_unique_id, options, text)
+    await progressive_reply.finish(text)
+
+
+async def process_voice_or_audio(message: types.Message, state: FSMContext, audio: bool = False) -> None:
+    yc_oauth_token, yc_folder_id = await chat_state.get(state)
+    if job_queue and settings.mode == 'intake':
+        await job_queue.add(Job.from_message(message, audio, yc_folder_id))
+        return
+    await recognize_message(message, audio, yc_oauth_token, yc_folder_id)
+
+
+async def process_job(job: Job) -> None:
+    state = dp.current_state(chat=job.chat_id, user=job.user_id)
+    # the chat may have logged out while the job was queued, its audio must not be billed to the bot's credentials
+    if await state.get_state() != AuthStates.authorized.state:
+        logging.info('Job for chat %s skipped, the chat is not authorized any more', job.chat_id)
+        return
+    yc_oauth_token, yc_folder_id = await chat_state.get(state)
+    await recognize_message(job.get_message(), job.audio, yc_oauth_token, job.folder_id or yc_folder_id)
+
+
+async def fail_job(job: Job) -> None:
+    await bot.send_message(job.chat_id, 'Не удалось распознать сообщение', reply_to_message_id=job.message_id)
+
+
+async def process_voice(message: types.Message, state: FSMContext) -> None:
+    await process_voice_or_audio(message, state, audio=False)
+
+
+async def process_audio(message: types.Message, state: FSMContext) -> None:
+    await process_voice_or_audio(message, state, audio=True)
+
+
+async def logout(message: types.Message, state: FSMContext):
+    yc_oauth_token, yc_folder_id = await chat_state.get(state)
+    await chat_state.set(state, ChatCredentials(None, yc_folder_id), AuthStates.welcome.state)
+    # chats of the permitted list use the bot's own credentials, there is no token of theirs to revoke
+    if yc_oauth_token:
+        try:
+            await yc_stt.revoke_token(yc_oauth_token)
+        except Exception:
+            logging.exception('Revoke token error')
+    await message.answer('Авторизация удалена')
+
+
+def get_folders_markup(folders: dict[str, str], selected_folder_id: str) -> types.InlineKeyboardMarkup:
+    return types.InlineKeyboardMarkup(inline_keyboard=[
+        [
+            types.InlineKeyboardButton(
+                f'✅ {folder_name}' if folder_id == selected_folder_id else folder_name,
+                callback_data=folder_id
+            )
+        ] for folder_id, folder_name in folders.items()
+    ])
+
+
+async def select_catalog(callback_query: types.CallbackQuery, state: FSMContext) -> None:
+    selected_folder_id = callback_query.data
+    yc_oauth_token, _ = await chat_state.get(state)
+    await chat_state.set(state, ChatCredentials(yc_oauth_token, selected_folder_id))
+    await callback_query.answer('Каталог выбран')
+    folders = await yc_stt.get_folders(yc_oauth_token)
+    await callback_query.message.edit_reply_markup(
+        reply_markup=get_folders_markup(folders, selected_folder_id)
+    )
+
+
+async def send_welcome(message: types.Message, state: FSMContext) -> None:
+    args = message.get_args()
+    if args:
+        payload = decode_payload(args)
+        token = await yc_stt.get_access_token(payload)
+        folders = await yc_stt.get_folders(token)
+        if not folders:
+            markup = types.InlineKeyboardMarkup(inline_keyboard=[
+                [
+                    types.InlineKeyboardButton('Открыть консоль Yandex Cloud', url='https://console.cloud.yandex.ru/')
+                ],
+            ])
+            await message.answer('Авторизация успешна, но у вас нет ни одного каталога в облаке.', reply_markup=markup)
+            return
+        selected_folder_id = next(iter(folders))
+        await chat_state.set(state, ChatCredentials(token, selected_folder_id), AuthStates.authorized.state)
+        await message.answer(f'Авторизация успешна. Доступные каталоги (выбранный отмечен галочкой):',
+                             reply_markup=get_folders_markup(folders, selected_folder_id))
+    elif message.chat.id not in settings.chat_id_permitted_list:
+        await AuthStates.wait_code.set()
+        url = yc_stt.get_authorization_url(
+            device_id=str(message.from_user.id),
+            device_name=f'@{message.from_user.username}' if message.from_user.username
+                        else message.from_user.first_name,
+            state=str(message.chat.id),
+        )
+        markup = types.InlineKeyboardMarkup(inline_keyboard=[
+            [
+                types.InlineKeyboardButton('Авторизоваться', url=url)
+            ],
+        ])
+        await message.answer(
+            'Для использования бота необходимо авторизоваться в Yandex Cloud',
+            reply_markup=markup,
+        )
+        return
+    else:
+        await AuthStates.authorized.set()
+    if message.chat.type == types.ChatType.PRIVATE:
+        await message.answer('Добавь меня в группу или перешли мне сообщение.')
+    else:
+        await message.answer('Готов.')
+
+
+async def start_command(message: types.Message, state: FSMContext) -> None:
+    await send_welcome(message, state)
+
+
+async def default_for_authorized_private(message: types.Message) -> None:
+    await message.answer('Добавь меня в группу или перешли мне сообщение.')
+
+
+async def default_for_private(message: types.Message, state: FSMContext) -> None:
+    await send_welcome(message, state)
+
+
+def register_handlers(dispatcher: Dispatcher) -> None:
+    dispatcher.register_message_handler(process_voice, state=AuthStates.authorized,
+                                        content_types=types.ContentType.VOICE)
+    dispatcher.register_message_handler(process_audio, state=AuthStates.authorized,
+                                        chat_type=types.ChatType.PRIVATE, content_types=types.ContentType.AUDIO)
+    dispatcher.register_message_handler(logout, state=AuthStates.authorized, commands=['logout'])
+    dispatcher.register_callback_query_handler(select_catalog, state=AuthStates.authorized)
+    dispatcher.register_message_handler(start_command, state='*', commands=['start'])
+    dispatcher.register_message_handler(default_for_authorized_private, state=AuthStates.authorized,
+                                        content_types=types.ContentType.ANY, chat_type=types.ChatType.PRIVATE)
+    dispatcher.register_message_handler(default_for_private, state='*', content_types=types.ContentType.ANY,
+                                        chat_type=types.ChatType.PRIVATE)
+
+
+def create_app() -> Dispatcher:
+    """Build the bot, its storage and the recognition pipeline and return the dispatcher with handlers registered.
+
+    Nothing connects here, connections are opened on first use or warmed up by ``on_startup``.
+    """
+    global bot, dp, redis, chat_state, scheduler, transcript_cache, job_queue, preprocessor
+    bot = Bot(
+        token=settings.api_token,
+        server=TelegramAPIServer.from_base(settings.telegram_api_server) if settings.telegram_api_server
+        else TELEGRAM_PRODUCTION,
+    )
+    storage = RedisStorage2(
+        settings.redis.host,
+        settings.redis.port,
+        db=settings.redis.db,
+        pool_size=settings.redis.pool_size,
+    )
+    dp = Dispatcher(bot, storage=storage)
+    redis = aioredis.Redis(
+        host=settings.redis.host,
+        port=settings.redis.port,
+        db=settings.redis.db or 0,
+        max_connections=settings.redis.pool_size,
+        decode_responses=True,
+    )
+    chat_state = ChatStateCache(redis, ttl=settings.chat_state.ttl, max_size=settings.chat_state.max_size)
+    transcript_cache = TranscriptCache(
+        redis,
+        ttl=settings.transcript_cache.ttl,
+        local_size=settings.transcript_cache.local_size,
+        max_length=settings.transcript_cache.max_length,
+    ) if settings.transcript_cache.enabled else None
+    scheduler = RecognitionScheduler(
+        settings.scheduler.max_concurrency,
+        settings.scheduler.max_per_chat,
+        settings.scheduler.max_per_folder,
+        settings.scheduler.max_queue_size,
+        settings.scheduler.max_queue_per_chat,
+    )
+    job_queue = JobQueue(redis, settings.jobs) if settings.mode != 'standalone' else None
+    preprocessor = AudioPreprocessor(settings.preprocessing) if settings.preprocessing.enabled else None
+    metrics.RECOGNITIONS_QUEUED.collect = lambda: {(): scheduler.queued}
+    register_handlers(dp)
+    return dp
+
+
+async def on_startup(dispatcher: Dispatcher) -> None:
+    global yc_stt
+    yc_stt = YcStt(
+        settings.yc_folder_id,
+        settings.yc_oauth_token,
+        settings.oauth,
+        settings.iam_cache,
+        settings.resource_manager,
+        settings.speechkit,
+        settings.yc_endpoints,
+    )
+    metrics.CHANNEL_IN_FLIGHT.collect = yc_stt.collect_channels_in_flight
+
+    async def warm_up() -> None:
+        with profile.measure('SpeechKit warm-up'):
+            await yc_stt.warm_up()
+
+    async def start_metrics_server(config: Metrics) -> None:
+        global metrics_runner
+        with profile.measure('metrics server'):
+            metrics_runner = await metrics.start_metrics_server(config.host, config.port, config.path)
+
+    steps = []
+    # intake processes do not recognize anything
+    if settings.mode != 'intake':
+        steps.append(warm_up())
+    if settings.metrics:
+        steps.append(start_metrics_server(settings.metrics))
+    await asyncio.gather(*steps)
+    logging.info('Started in %.2f s', profile.total)
+
+
+async def on_shutdown(dispatcher: Dispatcher) -> None:
+    await dispatcher.storage.close()
+    await dispatcher.storage.wait_closed()
+    await redis.close()
+    await redis.connection_pool.disconnect()
+    await yc_stt.close()
+    if metrics_runner:
+        await metrics_runner.cleanup()
+
+
+async def run_worker() -> None:
+    worker = JobWorker(job_queue, process_job, fail_job, settings.jobs)
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, worker.stop)
+    Bot.set_current(bot)
+    await on_startup(dp)
+    try:
+        await worker.run()
+    finally:
+        await on_shutdown(dp)
+        session = await bot.get_session()
+        await session.close()
@@ -0,0 +1,64 @@
+import asyncio
+from collections.abc import AsyncIterable, AsyncIterator
+from typing import Optional
+
+
+class ReplayableAudio:
+    """Audio source which can be read several times, also concurrently.
+
+    Chunks are pulled from the source once and kept, so a retried or hedged call replays what was already received
+    and then continues with the source. Without ``buffered`` nothing is kept and the audio can be read only once.
+    At most ``max_size`` bytes are kept, past that the audio is no longer replayable and a concurrent reader which
+    fell behind fails. An error of the source ends the audio and is kept in ``error``.
+    """
+
+    def __init__(self, source: AsyncIterable[bytes], buffered: bool = True, max_size: Optional[int] = None) -> None:
+        self.__source = source.__aiter__()
+        self.__buffered = buffered
+        self.__max_size = max_size
+        self.__chunks: list[bytes] = []
+        self.__size = 0
+        self.__pulled = 0
+        self.__lock = asyncio.Lock()
+        self.__exhausted = False
+        self.__readers = 0
+        self.error: Optional[Exception] = None
+
+    @property
+    def replayable(self) -> bool:
+        return self.__buffered or self.__readers == 0
+
+    async def read(self) -> AsyncIterator[bytes]:
+        if not self.replayable:
+            raise Exception('Audio is not buffered and was already read')
+        self.__readers += 1
+        index = 0
+        while True:
+            if index < len(self.__chunks):
+                yield self.__chunks[index]
+                index += 1
+                continue
+            async with self.__lock:
+                if index < len(self.__chunks):
+                    continue
+                if index < self.__pulled:
+                    raise Exception('Audio exceeded the replay buffer and was read further by another reader')
+                if self.__exhausted:
+                    return
+                try:
+                    chunk = await self.__source.__anext__()
+                except StopAsyncIteration:
+                    self.__exhausted = True
+                    return
+                except Exception as exc:
+                    self.error = exc
+                    self.__exhausted = True
+                    return
+                self.__pulled += 1
+                index = self.__pulled
+                if self.__buffered and self.__max_size is not None and self.__size + len(chunk) > self.__max_size:
+                    self.__buffered = False
+                if self.__buffered:
+                    self.__chunks.append(chunk)
+                    self.__size += len(chunk)
+            yield chunk
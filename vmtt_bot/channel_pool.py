@@ -0,0 +1,70 @@
+import itertools
+from collections.abc import Callable, Iterator, Sequence
+from contextlib import contextmanager
+from typing import Any, Optional, TypeVar
+
+import grpc
+
+StubT = TypeVar('StubT')
+
+
+class PooledChannel:
+    def __init__(self, channel: grpc.aio.Channel) -> None:
+        self.channel = channel
+        self.in_flight = 0
+        self.calls = 0
+        self.__stubs: dict[Callable, Any] = {}
+
+    def get_stub(self, stub_class: Callable[[grpc.aio.Channel], StubT]) -> StubT:
+        stub = self.__stubs.get(stub_class)
+        if stub is None:
+            stub = self.__stubs[stub_class] = stub_class(self.channel)
+        return stub
+
+
+class ChannelPool:
+    """Fixed set of gRPC channels, each with its own HTTP/2 connection.
+
+    Calls are spread over the channels either round-robin or to the channel with the least calls in flight.
+    """
+
+    def __init__(self, target: str, size: int = 1, selection: str = 'least_in_flight',
+                 credentials: Optional[grpc.ChannelCredentials] = None,
+                 options: Sequence[tuple[str, Any]] = ()) -> None:
+        if selection not in ('round_robin', 'least_in_flight'):
+            raise ValueError(f'Unknown channel selection: {selection}')
+        # without a local subchannel pool channels with equal arguments would share one connection
+        options = [*options, ('grpc.use_local_subchannel_pool', 1)]
+        self.__channels = [
+            PooledChannel(
+                grpc.aio.secure_channel(target, credentials, options) if credentials
+                else grpc.aio.insecure_channel(target, options)
+            )
+            for _ in range(size)
+        ]
+        self.__selection = selection
+        self.__round_robin = itertools.cycle(self.__channels)
+
+    @property
+    def channels(self) -> list[PooledChannel]:
+        return self.__channels
+
+    @contextmanager
+    def acquire(self, exclude: Optional[PooledChannel] = None) -> Iterator[PooledChannel]:
+        channels = [channel for channel in self.__channels if channel is not exclude] or self.__channels
+        if self.__selection == 'round_robin':
+            channel = next(self.__round_robin)
+            if channel not in channels:
+                channel = next(self.__round_robin)
+        else:
+            channel = min(channels, key=lambda c: c.in_flight)
+        channel.in_flight += 1
+        channel.calls += 1
+        try:
+            yield channel
+        finally:
+            channel.in_flight -= 1
+
+    async def close(self) -> None:
+        for channel in self.__channels:
+            await channel.channel.close()
@@ -0,0 +1,70 @@
+import json
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+import aioredis
+from aiogram.contrib.fsm_storage.redis import STATE_DATA_KEY, STATE_KEY, RedisStorage2
+from aiogram.dispatcher import FSMContext
+
+
+class ChatCredentials(NamedTuple):
+    yc_oauth_token: Optional[str]
+    yc_folder_id: Optional[str]
+
+
+class ChatStateCache:
+    """Per-chat Yandex Cloud credentials read from the FSM storage without a write-back.
+
+    Credentials are kept in process for ``ttl`` seconds, at most ``max_size`` chats. Writes go through ``set`` which
+    updates the cache and, for ``RedisStorage2``, sends the FSM state and data in one pipeline. Changes made by other
+    processes become visible here after ``ttl`` at most.
+    """
+
+    def __init__(self, redis: aioredis.Redis, ttl: float = 30, max_size: int = 10000) -> None:
+        self.__redis = redis
+        self.__ttl = ttl
+        self.__max_size = max_size
+        self.__entries: OrderedDict[tuple[str, str], tuple[float, ChatCredentials]] = OrderedDict()
+
+    async def get(self, state: FSMContext) -> ChatCredentials:
+        key = (str(state.chat), str(state.user))
+        entry = self.__entries.get(key)
+        if entry:
+            expires_at, credentials = entry
+            if expires_at > time.monotonic():
+                self.__entries.move_to_end(key)
+                return credentials
+            del self.__entries[key]
+        data = await state.get_data()
+        credentials = ChatCredentials(data.get('yc_oauth_token'), data.get('yc_folder_id'))
+        self.__store(key, credentials)
+        return credentials
+
+    async def set(self, state: FSMContext, credentials: ChatCredentials, state_name: Optional[str] = None) -> None:
+        key = (str(state.chat), str(state.user))
+        self.__entries.pop(key, None)
+        data = {name: value for name, value in credentials._asdict().items() if value is not None}
+        if isinstance(state.storage, RedisStorage2):
+            data_key = state.storage.generate_key(state.chat, state.user, STATE_DATA_KEY)
+            async with self.__redis.pipeline(transaction=True) as pipe:
+                if data:
+                    pipe.set(data_key, json.dumps(data))
+                else:
+                    pipe.delete(data_key)
+                if state_name is not None:
+                    pipe.set(state.storage.generate_key(state.chat, state.user, STATE_KEY), state_name)
+                await pipe.execute()
+        else:
+            await state.set_data(data)
+            if state_name is not None:
+                await state.set_state(state_name)
+        self.__store(key, credentials)
+
+    def __store(self, key: tuple[str, str], credentials: ChatCredentials) -> None:
+        if self.__ttl <= 0 or self.__max_size <= 0:
+            return
+        self.__entries[key] = (time.monotonic() + self.__ttl, credentials)
+        self.__entries.move_to_end(key)
+        while len(self.__entries) > self.__max_size:
+            self.__entries.popitem(last=False)
@@ -0,0 +1,107 @@
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable
+from datetime import datetime, timezone, timedelta
+from typing import TYPE_CHECKING, Optional
+
+from vmtt_bot.metrics import IAM_CACHE_REQUESTS
+
+if TYPE_CHECKING:
+    from vmtt_bot.yc_stt import IamToken
+
+METADATA_KEY = 'metadata'
+
+
+class _Entry:
+    def __init__(self, token: 'IamToken') -> None:
+        self.token = token
+        self.used = False
+        self.refresh_handle: Optional[asyncio.TimerHandle] = None
+
+
+class IamTokenCache:
+    """LRU cache of IAM tokens keyed by credential.
+
+    Entries used since the last fetch are refreshed in the background ``refresh_before`` ahead of expiration,
+    concurrent fetches for the same credential share a single request.
+    """
+
+    def __init__(self, fetch: Callable[[Optional[str]], Awaitable['IamToken']], max_size: int = 128,
+                 refresh_before: timedelta = timedelta(minutes=5),
+                 min_ttl: timedelta = timedelta(minutes=1)) -> None:
+        self.__fetch = fetch
+        self.__max_size = max_size
+        self.__refresh_before = refresh_before
+        self.__min_ttl = min_ttl
+        self.__entries: OrderedDict[str, _Entry] = OrderedDict()
+        self.__pending: dict[str, asyncio.Future['IamToken']] = {}
+        self.__background: set[asyncio.Future['IamToken']] = set()
+
+    @staticmethod
+    def get_key(oauth_token: Optional[str]) -> str:
+        if not oauth_token:
+            return METADATA_KEY
+        return hashlib.sha256(oauth_token.encode()).hexdigest()
+
+    async def get(self, oauth_token: Optional[str]) -> 'IamToken':
+        key = self.get_key(oauth_token)
+        entry = self.__entries.get(key)
+        if entry and entry.token.expires_at > datetime.now(timezone.utc) + self.__min_ttl:
+            self.__entries.move_to_end(key)
+            entry.used = True
+            IAM_CACHE_REQUESTS.inc('hit')
+            return entry.token
+        IAM_CACHE_REQUESTS.inc('miss')
+        return await self.__load(key, oauth_token)
+
+    def invalidate(self, oauth_token: Optional[str]) -> None:
+        entry = self.__entries.pop(self.get_key(oauth_token), None)
+        if entry and entry.refresh_handle:
+            entry.refresh_handle.cancel()
+
+    def close(self) -> None:
+        for entry in self.__entries.values():
+            if entry.refresh_handle:
+                entry.refresh_handle.cancel()
+        self.__entries.clear()
+        for future in list(self.__pending.values()):
+            future.cancel()
+
+    def __load(self, key: str, oauth_token: Optional[str]) -> asyncio.Future['IamToken']:
+        future = self.__pending.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self.__fetch_and_store(key, oauth_token))
+            self.__pending[key] = future
+            future.add_done_callback(lambda _: self.__pending.pop(key, None))
+        return asyncio.shield(future)
+
+    async def __fetch_and_store(self, key: str, oauth_token: Optional[str]) -> 'IamToken':
+        token = await self.__fetch(oauth_token)
+        self.invalidate(oauth_token)
+        entry = _Entry(token)
+        delay = (token.expires_at - datetime.now(timezone.utc) - self.__refresh_before).total_seconds()
+        if delay > 0:
+            entry.refresh_handle = asyncio.get_running_loop().call_later(delay, self.__refresh, key, oauth_token)
+        self.__entries[key] = entry
+        while len(self.__entries) > self.__max_size:
+            _, evicted = self.__entries.popitem(last=False)
+            if evicted.refresh_handle:
+                evicted.refresh_handle.cancel()
+        return token
+
+    def __refresh(self, key: str, oauth_token: Optional[str]) -> None:
+        entry = self.__entries.get(key)
+        if not entry or not entry.used:
+            return
+        if key in self.__pending:
+            return
+        task = self.__load(key, oauth_token)
+        self.__background.add(task)
+        task.add_done_callback(self.__on_refreshed)
+
+    def __on_refreshed(self, task: asyncio.Future['IamToken']) -> None:
+        self.__background.discard(task)
+        if not task.cancelled() and task.exception():
+            logging.warning('Background IAM token refresh failed: %r', task.exception())
@@ -0,0 +1,248 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+from collections.abc import Awaitable, Callable
+from typing import Any, NamedTuple, Optional
+
+import aioredis
+from aiogram import types
+
+from vmtt_bot.metrics import JOBS
+from vmtt_bot.settings import Jobs
+
+PENDING_SCAN_SIZE = 100
+RETRY_DELAY = 1
+
+
+def get_next_id(stream_id: str) -> str:
+    """Return the smallest stream entry ID greater than ``stream_id``."""
+    milliseconds, sequence = stream_id.split('-')
+    return f'{milliseconds}-{int(sequence) + 1}'
+
+
+class Job(NamedTuple):
+    """Recognition of one voice or audio message.
+
+    Credentials are not copied into the job, the worker reads them from the FSM storage of ``chat_id`` and
+    ``user_id``.
+    """
+    chat_id: int
+    user_id: int
+    message_id: int
+    file_id: str
+    file_unique_id: str
+    duration: int
+    audio: bool
+    folder_id: Optional[str] = None
+
+    @classmethod
+    def from_message(cls, message: types.Message, audio: bool, folder_id: Optional[str]) -> 'Job':
+        media = message.audio if audio else message.voice
+        return cls(
+            chat_id=message.chat.id,
+            user_id=message.from_user.id,
+            message_id=message.message_id,
+            file_id=media.file_id,
+            file_unique_id=media.file_unique_id,
+            duration=media.duration,
+            audio=audio,
+            folder_id=folder_id,
+        )
+
+    @classmethod
+    def from_fields(cls, fields: dict[str, str]) -> 'Job':
+        return cls(
+            chat_id=int(fields['chat_id']),
+            user_id=int(fields['user_id']),
+            message_id=int(fields['message_id']),
+            file_id=fields['file_id'],
+            file_unique_id=fields['file_unique_id'],
+            duration=int(fields['duration']),
+            audio=fields['audio'] == '1',
+            folder_id=fields.get('folder_id') or None,
+        )
+
+    def to_fields(self) -> dict[str, str]:
+        fields = {name: str(value) for name, value in self._asdict().items() if value is not None}
+        fields['audio'] = '1' if self.audio else '0'
+        return fields
+
+    def get_message(self) -> types.Message:
+        media = {'file_id': self.file_id, 'file_unique_id': self.file_unique_id, 'duration': self.duration}
+        return types.Message(**{
+            'message_id': self.message_id,
+            'chat': {'id': self.chat_id},
+            'from': {'id': self.user_id},
+            'audio' if self.audio else 'voice': media,
+        })
+
+
+class QueuedJob(NamedTuple):
+    id: str
+    job: Job
+    deliveries: int
+
+
+class JobQueue:
+    """Jobs in a Redis stream consumed by a consumer group.
+
+    A job stays pending until it is acknowledged. Jobs pending for ``claim_idle`` seconds belong to a dead or stuck
+    worker and are claimed by other workers.
+    """
+
+    def __init__(self, redis: aioredis.Redis, jobs: Jobs) -> None:
+        self.__redis = redis
+        self.__jobs = jobs
+        self.consumer = jobs.consumer or f'{socket.gethostname()}-{os.getpid()}'
+
+    async def add(self, job: Job) -> str:
+        fields: dict[Any, Any] = job.to_fields()
+        return await self.__redis.xadd(self.__jobs.stream, fields, maxlen=self.__jobs.max_length)
+
+    async def ensure_group(self) -> None:
+        try:
+            await self.__redis.xgroup_create(self.__jobs.stream, self.__jobs.group, id='0', mkstream=True)
+        except aioredis.ResponseError as exc:
+            if 'BUSYGROUP' not in str(exc):
+                raise
+
+    async def read(self, count: int, block: Optional[float] = None) -> list[QueuedJob]:
+        response = await self.__redis.xreadgroup(
+            self.__jobs.group, self.consumer, {self.__jobs.stream: '>'}, count=count,
+            block=int(block * 1000) if block is not None else None,
+        )
+        return [
+            QueuedJob(job_id, Job.from_fields(fields), 1)
+            for _, messages in response or ()
+            for job_id, fields in messages
+        ]
+
+    async def claim_stuck(self, count: int) -> list[QueuedJob]:
+        min_idle_time = int(self.__jobs.claim_idle * 1000)
+        # jobs in progress are kept fresh by their workers, the pending list is paged through past them
+        stuck: dict[Any, int] = {}
+        start = '-'
+        while len(stuck) < count:
+            pending = await self.__redis.xpending_range(
+                self.__jobs.stream, self.__jobs.group, min=start, max='+', count=PENDING_SCAN_SIZE,
+            )
+            for entry in pending:
+                if entry['time_since_delivered'] >= min_idle_time:
+                    stuck[entry['message_id']] = entry['times_delivered'] + 1
+            if len(pending) < PENDING_SCAN_SIZE:
+                break
+            start = get_next_id(pending[-1]['message_id'])
+        job_ids = list(stuck)[:count]
+        if not job_ids:
+            return []
+        # jobs trimmed from the stream while pending are dropped, Redis before 7.0 claims them without telling which
+        async with self.__redis.pipeline(transaction=False) as pipe:
+            for job_id in job_ids:
+                pipe.xrange(self.__jobs.stream, job_id, job_id)
+            entries = await pipe.execute()
+        trimmed = [job_id for job_id, entry in zip(job_ids, entries) if not entry]
+        if trimmed:
+            await self.__redis.xack(self.__jobs.stream, self.__jobs.group, *trimmed)
+            job_ids = [job_id for job_id in job_ids if job_id not in trimmed]
+            if not job_ids:
+                return []
+        claimed = await self.__redis.xclaim(
+            self.__jobs.stream, self.__jobs.group, self.consumer, min_idle_time, job_ids,
+        )
+        # an entry trimmed since the check above comes without an id, it is dropped on one of the next scans
+        return [
+            QueuedJob(job_id, Job.from_fields(fields), stuck[job_id])
+            for job_id, fields in claimed
+            if fields
+        ]
+
+    async def touch(self, job_ids: list[Any]) -> None:
+        if job_ids:
+            await self.__redis.xclaim(
+                self.__jobs.stream, self.__jobs.group, self.consumer, 0, job_ids, justid=True,
+            )
+
+    async def ack(self, job_id: str) -> None:
+        await self.__redis.xack(self.__jobs.stream, self.__jobs.group, job_id)
+
+
+class JobWorker:
+    """Runs jobs from a ``JobQueue``, at most ``concurrency`` at once.
+
+    A job is acknowledged once ``handler`` returns. A job whose handler raised is left pending and is run again
+    when claimed after ``claim_idle``, after ``max_deliveries`` runs it is passed to ``failed_handler`` instead and
+    acknowledged whether ``failed_handler`` succeeds or not. Jobs in progress are claimed again periodically, so
+    they are not taken over by other workers however long they take.
+    """
+
+    def __init__(self, queue: JobQueue, handler: Callable[[Job], Awaitable[None]],
+                 failed_handler: Callable[[Job], Awaitable[None]], jobs: Jobs) -> None:
+        self.__queue = queue
+        self.__handler = handler
+        self.__failed_handler = failed_handler
+        self.__jobs = jobs
+        self.__tasks: dict[asyncio.Task[None], str] = {}
+        self.__stopping = asyncio.Event()
+
+    def stop(self) -> None:
+        self.__stopping.set()
+
+    async def run(self) -> None:
+        await self.__queue.ensure_group()
+        heartbeat = asyncio.create_task(self.__heartbeat())
+        claimed_at = 0.0
+        try:
+            while not self.__stopping.is_set():
+                if len(self.__tasks) >= self.__jobs.concurrency:
+                    await asyncio.wait(self.__tasks, return_when=asyncio.FIRST_COMPLETED)
+                    continue
+                free = self.__jobs.concurrency - len(self.__tasks)
+                queued_jobs: list[QueuedJob] = []
+                try:
+                    if time.monotonic() - claimed_at >= self.__jobs.claim_idle / 2:
+                        claimed_at = time.monotonic()
+                        queued_jobs = await self.__queue.claim_stuck(free)
+                    if not queued_jobs:
+                        queued_jobs = await self.__queue.read(free, self.__jobs.block)
+                except aioredis.RedisError:
+                    logging.exception('Job queue read error')
+                    await asyncio.sleep(RETRY_DELAY)
+                    continue
+                for queued_job in queued_jobs:
+                    task = asyncio.create_task(self.__run_job(queued_job))
+                    self.__tasks[task] = queued_job.id
+                    task.add_done_callback(self.__tasks.pop)
+        finally:
+            if self.__tasks:
+                await asyncio.wait(self.__tasks)
+            heartbeat.cancel()
+            await asyncio.gather(heartbeat, return_exceptions=True)
+
+    async def __run_job(self, queued_job: QueuedJob) -> None:
+        if queued_job.deliveries > self.__jobs.max_deliveries:
+            logging.error('Job %s failed %s times, giving up', queued_job.id, queued_job.deliveries - 1)
+            JOBS.inc('failed')
+            try:
+                await self.__failed_handler(queued_job.job)
+            except Exception:
+                # the job is given up anyway, otherwise it would come back after every claim_idle
+                logging.exception('Job %s failed handler error', queued_job.id)
+        else:
+            try:
+                await self.__handler(queued_job.job)
+            except Exception:
+                logging.exception('Job %s error', queued_job.id)
+                JOBS.inc('error')
+                return
+            JOBS.inc('done')
+        await self.__queue.ack(queued_job.id)
+
+    async def __heartbeat(self) -> None:
+        while True:
+            await asyncio.sleep(self.__jobs.claim_idle / 3)
+            try:
+                await self.__queue.touch(list(self.__tasks.values()))
+            except aioredis.RedisError:
+                logging.exception('Job heartbeat error')
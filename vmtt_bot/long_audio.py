@@ -0,0 +1,204 @@
+import asyncio
+import bisect
+import string
+from collections.abc import AsyncIterator, Callable
+from typing import TYPE_CHECKING, Any, AsyncContextManager, NamedTuple, Optional
+
+from vmtt_bot.scheduler import QueueFull
+from vmtt_bot.yc_stt import YcStt
+
+if TYPE_CHECKING:
+    from yandex.cloud.ai.stt.v3 import stt_pb2
+
+MPEG1_BITRATES = (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320)
+MPEG2_BITRATES = (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160)
+SAMPLE_RATES = {
+    3: (44100, 48000, 32000),  # MPEG 1
+    2: (22050, 24000, 16000),  # MPEG 2
+    0: (11025, 12000, 8000),  # MPEG 2.5
+}
+PUNCTUATION = string.punctuation + '«»—…'
+# words at each edge of the overlap which may be fragments of a word cut by the segment boundary
+EDGE_WORDS = 2
+
+
+class Mp3Frame(NamedTuple):
+    offset: int
+    end: int
+    start_time: float
+
+
+def parse_mp3_frame_header(header: bytes) -> Optional[tuple[int, float]]:
+    """Return length and duration of an MPEG Layer III frame, ``None`` if it is not a valid header."""
+    if len(header) < 4 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        return None
+    version = (header[1] >> 3) & 0x03
+    layer = (header[1] >> 1) & 0x03
+    bitrate_index = header[2] >> 4
+    sample_rate_index = (header[2] >> 2) & 0x03
+    padding = (header[2] >> 1) & 0x01
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+    sample_rate = SAMPLE_RATES[version][sample_rate_index]
+    if version == 3:
+        length = 144000 * MPEG1_BITRATES[bitrate_index] // sample_rate + padding
+        samples = 1152
+    else:
+        length = 72000 * MPEG2_BITRATES[bitrate_index] // sample_rate + padding
+        samples = 576
+    return length, samples / sample_rate
+
+
+def parse_mp3_frames(data: bytes) -> list[Mp3Frame]:
+    pos = 0
+    if data[:3] == b'ID3' and len(data) >= 10:
+        size = (data[6] & 0x7F) << 21 | (data[7] & 0x7F) << 14 | (data[8] & 0x7F) << 7 | (data[9] & 0x7F)
+        pos = size + (20 if data[5] & 0x10 else 10)
+    frames: list[Mp3Frame] = []
+    time = 0.0
+    while pos + 4 <= len(data):
+        header = parse_mp3_frame_header(data[pos:pos + 4])
+        if header is None:
+            pos += 1
+            continue
+        length, duration = header
+        frames.append(Mp3Frame(pos, min(pos + length, len(data)), time))
+        time += duration
+        pos += length
+    return frames
+
+
+def split_mp3(data: bytes, segment_duration: float, overlap: float) -> list[bytes]:
+    """Split MP3 into windows of ``segment_duration`` seconds on frame boundaries.
+
+    Each window also takes the first ``overlap`` seconds of the next one, so words cut at a boundary are recognized
+    whole in at least one of them. Data without recognizable frames is returned as a single segment.
+    """
+    frames = parse_mp3_frames(data)
+    if not frames:
+        return [data]
+    start_times = [frame.start_time for frame in frames]
+    segments: list[bytes] = []
+    start = 0
+    while True:
+        segment_start = start_times[start]
+        end = max(bisect.bisect_left(start_times, segment_start + segment_duration + overlap), start + 1)
+        segments.append(data[frames[start].offset:frames[end - 1].end])
+        if end >= len(frames):
+            return segments
+        # a segment is one frame at least, however short ``segment_duration`` is
+        start = max(bisect.bisect_left(start_times, segment_start + segment_duration), start + 1)
+
+
+def split_pcm(data: bytes, sample_rate: int, segment_duration: float, overlap: float) -> list[bytes]:
+    """Split 16-bit mono PCM into windows of ``segment_duration`` seconds overlapping like ``split_mp3``."""
+    bytes_per_second = sample_rate * 2
+    step = int(segment_duration * bytes_per_second) // 2 * 2
+    length = int((segment_duration + overlap) * bytes_per_second) // 2 * 2
+    if step <= 0 or len(data) <= length:
+        return [data]
+    segments: list[bytes] = []
+    for start in range(0, len(data), step):
+        segments.append(data[start:start + length])
+        if start + length >= len(data):
+            break
+    return segments
+
+
+def merge_transcripts(left: str, right: str, max_overlap_words: int) -> str:
+    """Join transcripts of adjacent segments dropping words repeated at the boundary.
+
+    The repeated words are the longest common run of at most ``max_overlap_words`` words ending near the end of
+    ``left`` and starting near the beginning of ``right``. Up to ``EDGE_WORDS`` words on each side of the run may
+    differ, as words cut by the segment boundary are recognized as fragments. The left transcript is cut after the
+    run and the right one before it.
+    """
+    left_words = left.split()
+    right_words = right.split()
+
+    def normalize(words: list[str]) -> list[str]:
+        return [word.strip(PUNCTUATION).lower() for word in words]
+
+    window = max_overlap_words + EDGE_WORDS
+    left_offset = max(len(left_words) - window, 0)
+    left_tail = normalize(left_words[left_offset:])
+    right_head = normalize(right_words[:window])
+    # (run length, skipped edge words), the longest run wins and the one with fewer fragments among equal ones
+    best: Optional[tuple[int, int]] = None
+    cut = (len(left_words), 0)
+    for j in range(min(EDGE_WORDS, len(right_head) - 1) + 1):
+        for i in range(len(left_tail)):
+            count = 0
+            while (
+                count < max_overlap_words and i + count < len(left_tail) and j + count < len(right_head)
+                and left_tail[i + count] == right_head[j + count]
+            ):
+                count += 1
+            skipped = len(left_tail) - i - count
+            # a single common word is a coincidence rather than an overlap unless the edges match exactly
+            if not count or skipped > EDGE_WORDS or count < 2 and skipped + j:
+                continue
+            if best is None or (count, -skipped - j) > (best[0], -best[1]):
+                best = count, skipped + j
+                cut = left_offset + i + count, j + count
+    return ' '.join(left_words[:cut[0]] + right_words[cut[1]:])
+
+
+async def recognize_segments(yc_stt: YcStt, segments: list[bytes], concurrency: int, chunk_size: int,
+                             max_overlap_words: int, yc_oauth_token: str = None, yc_folder_id: str = None,
+                             audio_format: Optional['stt_pb2.AudioFormatOptions'] = None,
+                             acquire_slot: Optional[Callable[[], AsyncContextManager[Any]]] = None,
+                             ) -> AsyncIterator[str]:
+    """Recognize MP3 segments, or segments of ``audio_format``, concurrently.
+
+    Segments are taken in order by up to ``concurrency`` workers. The first one runs right away under the slot the
+    caller holds, each other one first enters ``acquire_slot()``, so segments count against the scheduler limits
+    like separate recognitions. A worker which can't be queued with ``QueueFull`` doesn't run.
+
+    Yields the stitched transcript each time it grows, that is when the leftmost unfinished segment completes. The
+    last yielded value is the whole transcript.
+    """
+    loop = asyncio.get_running_loop()
+    results: list[asyncio.Future[str]] = [loop.create_future() for _ in segments]
+    indexes = iter(range(len(segments)))
+
+    async def iter_chunks(segment: bytes) -> AsyncIterator[bytes]:
+        for pos in range(0, len(segment), chunk_size):
+            yield segment[pos:pos + chunk_size]
+
+    async def work() -> None:
+        # the iterator is shared, each segment is taken by one worker
+        for index in indexes:
+            try:
+                text = await yc_stt.recognize(iter_chunks(segments[index]), True, yc_oauth_token, yc_folder_id,
+                                              audio_format)
+            except Exception as exc:
+                results[index].set_exception(exc)
+                return
+            results[index].set_result(text)
+
+    async def work_in_slot() -> None:
+        assert acquire_slot
+        try:
+            slot = acquire_slot()
+        except QueueFull:
+            return
+        async with slot:
+            await work()
+
+    workers = min(concurrency, len(segments))
+    tasks = [asyncio.create_task(work())]
+    tasks += [asyncio.create_task(work_in_slot() if acquire_slot else work()) for _ in range(workers - 1)]
+    text = ''
+    try:
+        for result in results:
+            text = merge_transcripts(text, await result, max_overlap_words)
+            yield text
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for result in results:
+            # errors of segments after the one which failed are not reported
+            if result.done() and not result.cancelled():
+                result.exception()
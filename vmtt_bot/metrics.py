@@ -0,0 +1,150 @@
+import bisect
+import time
+from collections.abc import Callable, Iterator, Sequence
+from contextlib import contextmanager
+from typing import Optional
+
+from aiohttp import web
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+LabelValues = tuple[str, ...]
+
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(name, value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in zip(names, values)
+    )
+    return f'{{{pairs}}}'
+
+
+class Metric:
+    type = ''
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        REGISTRY.append(self)
+
+    def render(self) -> Iterator[str]:
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} {self.type}'
+        yield from self.render_samples()
+
+    def render_samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, label_names)
+        self.__values: dict[LabelValues, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self.__values[labels] = self.__values.get(labels, 0) + amount
+
+    def render_samples(self) -> Iterator[str]:
+        for labels, value in self.__values.items():
+            yield f'{self.name}{format_labels(self.label_names, labels)} {value}'
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = (),
+                 collect: Optional[Callable[[], dict[LabelValues, float]]] = None) -> None:
+        super().__init__(name, documentation, label_names)
+        self.__values: dict[LabelValues, float] = {}
+        self.collect = collect
+
+    def set(self, value: float, *labels: str) -> None:
+        self.__values[labels] = value
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self.__values[labels] = self.__values.get(labels, 0) + amount
+
+    def dec(self, *labels: str, amount: float = 1) -> None:
+        self.inc(*labels, amount=-amount)
+
+    def render_samples(self) -> Iterator[str]:
+        values = self.collect() if self.collect else self.__values
+        for labels, value in values.items():
+            yield f'{self.name}{format_labels(self.label_names, labels)} {value}'
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+        self.__counts: dict[LabelValues, list[int]] = {}
+        self.__sums: dict[LabelValues, float] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        counts = self.__counts.get(labels)
+        if counts is None:
+            counts = self.__counts[labels] = [0] * (len(self.buckets) + 1)
+            self.__sums[labels] = 0.0
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.__sums[labels] += value
+
+    @contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def render_samples(self) -> Iterator[str]:
+        label_names = (*self.label_names, 'le')
+        for labels, counts in self.__counts.items():
+            cumulative = 0
+            for bound, count in zip((*map(str, self.buckets), '+Inf'), counts):
+                cumulative += count
+                yield f'{self.name}_bucket{format_labels(label_names, (*labels, bound))} {cumulative}'
+            yield f'{self.name}_sum{format_labels(self.label_names, labels)} {self.__sums[labels]}'
+            yield f'{self.name}_count{format_labels(self.label_names, labels)} {cumulative}'
+
+
+REGISTRY: list[Metric] = []
+
+STAGE_DURATION = Histogram(
+    'vmtt_stage_duration_seconds', 'Duration of message processing stages.', ['stage'],
+)
+GRPC_ERRORS = Counter('vmtt_grpc_errors_total', 'SpeechKit calls failed with a gRPC status code.', ['code'])
+AUDIO_BYTES = Counter('vmtt_audio_bytes_total', 'Audio bytes streamed to SpeechKit.')
+IAM_CACHE_REQUESTS = Counter('vmtt_iam_cache_requests_total', 'IAM token cache lookups.', ['result'])
+TRANSCRIPT_CACHE_REQUESTS = Counter(
+    'vmtt_transcript_cache_requests_total', 'Transcript cache lookups.', ['result'],
+)
+RECOGNITIONS_IN_FLIGHT = Gauge('vmtt_recognitions_in_flight', 'SpeechKit recognitions in progress.')
+RECOGNITIONS_QUEUED = Gauge('vmtt_recognitions_queued', 'Recognitions waiting in the scheduler queue.')
+JOBS = Counter('vmtt_jobs_total', 'Jobs run by workers.', ['result'])
+CHANNEL_IN_FLIGHT = Gauge('vmtt_channel_in_flight', 'SpeechKit calls in progress per gRPC channel.', ['channel'])
+
+
+def render() -> str:
+    return '\n'.join(line for metric in REGISTRY for line in metric.render()) + '\n'
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(body=render().encode(), headers={'Content-Type': CONTENT_TYPE})
+
+
+async def start_metrics_server(host: str, port: int, path: str = '/metrics') -> web.AppRunner:
+    app = web.Application()
+    app.router.add_get(path, handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
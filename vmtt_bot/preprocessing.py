@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+import time
+from collections.abc import AsyncIterable, AsyncIterator
+from typing import TYPE_CHECKING, Optional
+
+from vmtt_bot.metrics import STAGE_DURATION
+from vmtt_bot.settings import Preprocessing
+from vmtt_bot.yc_stt import RecognitionError
+
+if TYPE_CHECKING:
+    from yandex.cloud.ai.stt.v3 import stt_pb2
+
+# formats ffmpeg cannot demux from a pipe in general, the moov atom of MP4 may be at the end of the file
+SEEKABLE_FORMATS = ('mov',)
+
+
+class PreprocessingError(RecognitionError):
+    pass
+
+
+def detect_format(header: bytes) -> Optional[str]:
+    """Return the ffmpeg demuxer for the leading bytes of a file, ``None`` if it is not known."""
+    if header.startswith(b'OggS'):
+        return 'ogg'
+    if header.startswith(b'ID3'):
+        return 'mp3'
+    if header.startswith(b'RIFF') and header[8:12] == b'WAVE':
+        return 'wav'
+    if header.startswith(b'fLaC'):
+        return 'flac'
+    if header.startswith(b'\x1a\x45\xdf\xa3'):
+        return 'matroska'
+    if header[4:8] == b'ftyp':
+        return 'mov'
+    if len(header) >= 2 and header[0] == 0xFF and header[1] & 0xE0 == 0xE0:
+        # ADTS frames share the sync word with MPEG audio and have layer bits set to zero
+        return 'aac' if header[1] & 0x06 == 0 else 'mp3'
+    return None
+
+
+class AudioPreprocessor:
+    """Decode audio of any format ffmpeg knows into mono audio SpeechKit recognizes best.
+
+    The audio is downmixed, resampled to ``sample_rate``, optionally stripped of leading and trailing silence and
+    encoded as LINEAR16 PCM or OGG Opus. Each file is processed by its own ffmpeg process, at most
+    ``max_processes`` at once, so decoding runs outside of the event loop. Trimming trailing silence needs the whole
+    file, with ``trim_silence`` the output starts only after the input is read.
+    """
+
+    def __init__(self, preprocessing: Preprocessing) -> None:
+        ffmpeg = shutil.which(preprocessing.ffmpeg)
+        if not ffmpeg:
+            raise Exception(f'ffmpeg not found: {preprocessing.ffmpeg}')
+        self.__ffmpeg = ffmpeg
+        self.__preprocessing = preprocessing
+        self.__semaphore = asyncio.Semaphore(preprocessing.max_processes)
+
+    @property
+    def audio_format(self) -> 'stt_pb2.AudioFormatOptions':
+        from yandex.cloud.ai.stt.v3 import stt_pb2
+
+        if self.__preprocessing.encoding == 'linear16':
+            return stt_pb2.AudioFormatOptions(
+                raw_audio=stt_pb2.RawAudio(
+                    audio_encoding=stt_pb2.RawAudio.LINEAR16_PCM,
+                    sample_rate_hertz=self.__preprocessing.sample_rate,
+                    audio_channel_count=1,
+                ),
+            )
+        return stt_pb2.AudioFormatOptions(
+            container_audio=stt_pb2.ContainerAudio(container_audio_type=stt_pb2.ContainerAudio.OGG_OPUS),
+        )
+
+    def get_arguments(self, input_format: Optional[str], input_path: str = 'pipe:0') -> list[str]:
+        preprocessing = self.__preprocessing
+        arguments = [self.__ffmpeg, '-hide_banner', '-loglevel', 'error']
+        if input_format:
+            arguments += ['-f', input_format]
+        arguments += ['-i', input_path, '-vn', '-ac', '1', '-ar', str(preprocessing.sample_rate)]
+        if preprocessing.trim_silence:
+            trim = f'silenceremove=start_periods=1:start_threshold={preprocessing.silence_threshold}dB'
+            arguments += ['-af', f'{trim},areverse,{trim},areverse']
+        if preprocessing.encoding == 'linear16':
+            arguments += ['-c:a', 'pcm_s16le', '-f', 's16le']
+        else:
+            arguments += ['-c:a', 'libopus', '-b:a', str(preprocessing.opus_bitrate), '-f', 'ogg']
+        return [*arguments, 'pipe:1']
+
+    async def process(self, audio_chunks: AsyncIterable[bytes], chunk_size: int = 4000) -> AsyncIterator[bytes]:
+        source = audio_chunks.__aiter__()
+        try:
+            header = await source.__anext__()
+        except StopAsyncIteration:
+            return
+        input_format = detect_format(header)
+
+        async def iter_source() -> AsyncIterator[bytes]:
+            yield header
+            async for chunk in source:
+                yield chunk
+
+        async with self.__semaphore:
+            started_at = time.perf_counter()
+            if input_format in SEEKABLE_FORMATS:
+                async for chunk in self.__process_file(iter_source(), input_format, chunk_size):
+                    yield chunk
+            else:
+                async for chunk in self.__run(self.get_arguments(input_format), iter_source(), chunk_size):
+                    yield chunk
+            STAGE_DURATION.observe(time.perf_counter() - started_at, 'preprocessing')
+
+    async def __process_file(self, audio_chunks: AsyncIterable[bytes], input_format: str,
+                             chunk_size: int) -> AsyncIterator[bytes]:
+        fd, path = tempfile.mkstemp(prefix='vmtt-', suffix=f'.{input_format}')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                async for chunk in audio_chunks:
+                    await asyncio.to_thread(file.write, chunk)
+            async for chunk in self.__run(self.get_arguments(input_format, path), None, chunk_size):
+                yield chunk
+        finally:
+            os.unlink(path)
+
+    async def __run(self, arguments: list[str], audio_chunks: Optional[AsyncIterable[bytes]],
+                    chunk_size: int) -> AsyncIterator[bytes]:
+        process = await asyncio.create_subprocess_exec(
+            *arguments,
+            stdin=asyncio.subprocess.PIPE if audio_chunks is not None else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        assert process.stdout and process.stderr
+
+        async def feed(audio_chunks: AsyncIterable[bytes]) -> None:
+            assert process.stdin
+            try:
+                async for chunk in audio_chunks:
+                    process.stdin.write(chunk)
+                    await process.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                # ffmpeg stopped reading, its exit status tells why
+                pass
+            finally:
+                process.stdin.close()
+
+        feeder = asyncio.create_task(feed(audio_chunks)) if audio_chunks is not None else None
+        stderr = asyncio.create_task(process.stderr.read())
+        try:
+            while chunk := await process.stdout.read(chunk_size):
+                yield chunk
+            if feeder:
+                await feeder
+            if await process.wait():
+                message = (await stderr).decode(errors='replace').strip()
+                logging.warning('ffmpeg exited with %s: %s', process.returncode, message)
+                raise PreprocessingError('Не удалось распознать формат аудио')
+        finally:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            for task in (feeder, stderr):
+                if task:
+                    task.cancel()
+            await asyncio.gather(*(task for task in (feeder, stderr) if task), return_exceptions=True)
@@ -0,0 +1,70 @@
+import asyncio
+import logging
+
+from aiogram import types
+from aiogram.utils import exceptions
+from aiogram.utils.parts import MAX_MESSAGE_LENGTH, safe_split_text
+
+IN_PROGRESS_MARK = ' …'
+# the mark is appended to the last part, parts are the same whether the transcript is finished or not
+MAX_PART_LENGTH = MAX_MESSAGE_LENGTH - len(IN_PROGRESS_MARK)
+
+
+class ProgressiveReply:
+    """Reply which is posted early and edited while the transcript grows.
+
+    Edits are sent at most once per ``interval`` seconds to stay under Telegram rate limits. When ``progressive`` is
+    false intermediate updates are ignored and only the final text is sent. A transcript longer than a Telegram
+    message is continued in further replies. Failed intermediate edits are logged and skipped, a reply which can't
+    be edited any more is replaced with a new one.
+    """
+
+    def __init__(self, message: types.Message, interval: float, progressive: bool = True) -> None:
+        self.__message = message
+        self.__interval = interval
+        self.__progressive = progressive
+        self.__replies: list[types.Message] = []
+        self.__texts: list[str] = []
+        self.__sent_at = 0.0
+
+    async def update(self, text: str) -> None:
+        if not self.__progressive or not text:
+            return
+        if asyncio.get_running_loop().time() - self.__sent_at < self.__interval:
+            return
+        try:
+            await self.__send(text, IN_PROGRESS_MARK)
+        except exceptions.RetryAfter as exc:
+            logging.warning('Progressive reply throttled for %s seconds', exc.timeout)
+            self.__sent_at = asyncio.get_running_loop().time() + exc.timeout
+        except exceptions.TelegramAPIError as exc:
+            logging.warning('Progressive reply update failed: %s', exc)
+            self.__sent_at = asyncio.get_running_loop().time()
+
+    async def finish(self, text: str) -> None:
+        await self.__send(text)
+
+    async def __send(self, text: str, mark: str = '') -> None:
+        parts = safe_split_text(text, MAX_PART_LENGTH) or ['']
+        parts[-1] += mark
+        for index, part in enumerate(parts):
+            if index == len(self.__replies):
+                self.__replies.append(await self.__message.reply(part))
+                self.__texts.append(part)
+            elif part != self.__texts[index]:
+                try:
+                    await self.__replies[index].edit_text(part)
+                except (exceptions.MessageToEditNotFound, exceptions.MessageCantBeEdited):
+                    self.__replies[index] = await self.__message.reply(part)
+                except exceptions.MessageNotModified:
+                    pass
+                self.__texts[index] = part
+        # the transcript may get shorter when the recognizer revises it
+        while len(self.__replies) > len(parts):
+            reply = self.__replies.pop()
+            self.__texts.pop()
+            try:
+                await reply.delete()
+            except exceptions.TelegramAPIError as exc:
+                logging.warning('Stale progressive reply not deleted: %s', exc)
+        self.__sent_at = asyncio.get_running_loop().time()
@@ -0,0 +1,145 @@
+import asyncio
+from collections import Counter, OrderedDict, deque
+from types import TracebackType
+from typing import Optional
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Ticket:
+    def __init__(self, scheduler: 'RecognitionScheduler', chat_id: int, folder_id: str) -> None:
+        self.chat_id = chat_id
+        self.folder_id = folder_id
+        self.position = 0
+        self.granted = asyncio.get_running_loop().create_future()
+        self.__scheduler = scheduler
+
+    async def __aenter__(self) -> 'Ticket':
+        try:
+            await asyncio.shield(self.granted)
+        except asyncio.CancelledError:
+            self.__scheduler.cancel(self)
+            raise
+        return self
+
+    async def __aexit__(self, exc_type: Optional[type[BaseException]], exc: Optional[BaseException],
+                        tb: Optional[TracebackType]) -> None:
+        self.__scheduler.release(self)
+
+
+class RecognitionScheduler:
+    """Admission control for recognitions.
+
+    Limits recognitions running at once globally, per chat and per folder. Waiting tickets are kept in per-chat
+    queues which are served round-robin, so a busy chat can't starve the others. A recognition which may start
+    right away is never rejected, queues are limited to ``max_queue_size`` tickets in total and to
+    ``max_queue_per_chat`` tickets per chat.
+    """
+
+    def __init__(self, max_concurrency: int, max_per_chat: int, max_per_folder: int, max_queue_size: int,
+                 max_queue_per_chat: int) -> None:
+        self.__max_concurrency = max_concurrency
+        self.__max_per_chat = max_per_chat
+        self.__max_per_folder = max_per_folder
+        self.__max_queue_size = max_queue_size
+        self.__max_queue_per_chat = max_queue_per_chat
+        self.__running = 0
+        self.__running_chats: Counter[int] = Counter()
+        self.__running_folders: Counter[str] = Counter()
+        self.__queues: OrderedDict[int, deque[Ticket]] = OrderedDict()
+        self.__queued = 0
+
+    @property
+    def running(self) -> int:
+        return self.__running
+
+    @property
+    def queued(self) -> int:
+        return self.__queued
+
+    def enqueue(self, chat_id: int, folder_id: Optional[str]) -> Ticket:
+        """Put a recognition in line, ``position`` of the returned ticket is zero if it may start right away.
+
+        Otherwise it is the place in line the ticket would have if the queues were served strictly round-robin.
+        """
+        ticket = Ticket(self, chat_id, folder_id or '')
+        queue = self.__queues.get(chat_id)
+        if not queue and self.__can_run(ticket):
+            self.__start(ticket)
+            return ticket
+        if self.__queued >= self.__max_queue_size or (queue and len(queue) >= self.__max_queue_per_chat):
+            raise QueueFull()
+        self.__queues.setdefault(chat_id, deque()).append(ticket)
+        self.__queued += 1
+        self.__dispatch()
+        if not ticket.granted.done():
+            ticket.position = self.__get_position(ticket)
+        return ticket
+
+    def release(self, ticket: Ticket) -> None:
+        self.__running -= 1
+        self.__running_chats.subtract((ticket.chat_id,))
+        if not self.__running_chats[ticket.chat_id]:
+            del self.__running_chats[ticket.chat_id]
+        self.__running_folders.subtract((ticket.folder_id,))
+        if not self.__running_folders[ticket.folder_id]:
+            del self.__running_folders[ticket.folder_id]
+        self.__dispatch()
+
+    def cancel(self, ticket: Ticket) -> None:
+        if ticket.granted.done():
+            self.release(ticket)
+            return
+        ticket.granted.cancel()
+        queue = self.__queues.get(ticket.chat_id)
+        if queue is not None and ticket in queue:
+            queue.remove(ticket)
+            self.__queued -= 1
+            if not queue:
+                del self.__queues[ticket.chat_id]
+
+    def __can_run(self, ticket: Ticket) -> bool:
+        return (
+            self.__running < self.__max_concurrency
+            and self.__running_chats[ticket.chat_id] < self.__max_per_chat
+            and self.__running_folders[ticket.folder_id] < self.__max_per_folder
+        )
+
+    def __get_position(self, ticket: Ticket) -> int:
+        own_queue = self.__queues[ticket.chat_id]
+        index = own_queue.index(ticket)
+        position = index + 1
+        before = True
+        for chat_id, queue in self.__queues.items():
+            if chat_id == ticket.chat_id:
+                before = False
+                continue
+            # chats earlier in the rotation get one turn more before this ticket's turn
+            position += min(len(queue), index + 1 if before else index)
+        return position
+
+    def __start(self, ticket: Ticket) -> None:
+        self.__running += 1
+        self.__running_chats[ticket.chat_id] += 1
+        self.__running_folders[ticket.folder_id] += 1
+        ticket.granted.set_result(None)
+
+    def __dispatch(self) -> None:
+        granted = True
+        while granted and self.__running < self.__max_concurrency:
+            granted = False
+            for chat_id, queue in self.__queues.items():
+                ticket = queue[0]
+                if not self.__can_run(ticket):
+                    continue
+                queue.popleft()
+                self.__queued -= 1
+                if queue:
+                    self.__queues.move_to_end(chat_id)
+                else:
+                    del self.__queues[chat_id]
+                self.__start(ticket)
+                granted = True
+                break
@@ -1,6 +1,6 @@
-from typing import Optional
+from typing import Literal, Optional
 
-from pydantic import BaseSettings, BaseModel, AnyHttpUrl
+from pydantic import BaseSettings, BaseModel, AnyHttpUrl, validator
 
 
 class OAuth(BaseModel):
@@ -13,17 +13,159 @@ class Redis(BaseModel):
     host: str = 'localhost'
     port: int = 6379
     db: Optional[int] = None
+    pool_size: int = 10
+
+
+class YcEndpoints(BaseModel):
+    iam_tokens: AnyHttpUrl = 'https://iam.api.cloud.yandex.net/iam/v1/tokens'
+    compute_metadata_token: AnyHttpUrl = (
+        'http://169.254.169.254/computeMetadata/v1/instance/service-accounts/default/token'
+    )
+    resource_manager: AnyHttpUrl = 'https://resource-manager.api.cloud.yandex.net/resource-manager/v1'
+
+
+class IamCache(BaseModel):
+    max_size: int = 128
+    refresh_before: int = 300
+
+
+class ResourceManager(BaseModel):
+    concurrency: int = 8
+    cache_ttl: int = 60
+    cache_size: int = 128
+
+
+class SpeechKit(BaseModel):
+    endpoint: str = 'stt.api.cloud.yandex.net:443'
+    secure: bool = True
+    chunk_size: int = 4000
+    channels: int = 2
+    channel_selection: Literal['round_robin', 'least_in_flight'] = 'least_in_flight'
+    keepalive_time_ms: int = 30000
+    keepalive_timeout_ms: int = 10000
+    idle_timeout_ms: int = 300000
+    max_message_length: int = 4 * 1024 * 1024
+    warm_up_timeout: float = 5
+    deadline: float = 600
+    retry_attempts: int = 3
+    replay_buffer_size: int = 2 * 1024 * 1024
+    retry_status_codes: list[str] = ['UNAVAILABLE', 'RESOURCE_EXHAUSTED', 'ABORTED']
+    retry_initial_backoff: float = 0.5
+    retry_max_backoff: float = 10
+    retry_backoff_multiplier: float = 2
+    hedging: bool = False
+    hedge_after: float = 3
+
+
+class Progress(BaseModel):
+    min_duration: int = 30
+    edit_interval: float = 3.0
+    partials: bool = False
+
+
+class LongAudio(BaseModel):
+    enabled: bool = True
+    min_duration: int = 300
+    segment_duration: float = 60
+    overlap: float = 2
+    concurrency: int = 4
+    max_overlap_words: int = 10
+
+    @validator('segment_duration', 'concurrency')
+    def check_positive(cls, value: float) -> float:
+        if value <= 0:
+            raise ValueError('must be greater than 0')
+        return value
+
+    @validator('overlap', 'max_overlap_words')
+    def check_not_negative(cls, value: float) -> float:
+        if value < 0:
+            raise ValueError('must not be negative')
+        return value
+
+
+class Preprocessing(BaseModel):
+    enabled: bool = False
+    ffmpeg: str = 'ffmpeg'
+    encoding: Literal['linear16', 'ogg_opus'] = 'ogg_opus'
+    sample_rate: int = 16000
+    opus_bitrate: int = 32000
+    trim_silence: bool = True
+    silence_threshold: float = -50
+    max_processes: int = 4
+
+
+class Scheduler(BaseModel):
+    max_concurrency: int = 32
+    max_per_chat: int = 2
+    max_per_folder: int = 10
+    max_queue_size: int = 200
+    max_queue_per_chat: int = 20
+
+
+class TranscriptCache(BaseModel):
+    enabled: bool = True
+    ttl: int = 7 * 24 * 60 * 60
+    local_size: int = 1000
+    max_length: int = 16384
+
+
+class ChatState(BaseModel):
+    ttl: float = 30
+    max_size: int = 10000
+
+
+class Jobs(BaseModel):
+    stream: str = 'vmtt:jobs'
+    group: str = 'workers'
+    consumer: Optional[str] = None
+    concurrency: int = 16
+    block: float = 5
+    claim_idle: float = 60
+    max_deliveries: int = 3
+    max_length: int = 100000
+
+
+class Webhook(BaseModel):
+    url: Optional[AnyHttpUrl] = None
+    host: str = '0.0.0.0'
+    port: int = 8080
+    path: str = '/webhook'
+    secret_token: Optional[str] = None
+    ssl_certificate: Optional[str] = None
+    ssl_private_key: Optional[str] = None
+
+
+class Metrics(BaseModel):
+    host: str = '0.0.0.0'
+    port: int = 9090
+    path: str = '/metrics'
 
 
 class Settings(BaseSettings):
     api_token: str
+    telegram_api_server: Optional[AnyHttpUrl] = None
     log_level: str = 'DEBUG'
+    mode: Literal['standalone', 'intake', 'worker'] = 'standalone'
 
     yc_oauth_token: Optional[str] = None
     yc_folder_id: Optional[str] = None
     oauth: Optional[OAuth] = None
+    yc_endpoints: YcEndpoints = YcEndpoints()
+    iam_cache: IamCache = IamCache()
+    resource_manager: ResourceManager = ResourceManager()
+    speechkit: SpeechKit = SpeechKit()
+    scheduler: Scheduler = Scheduler()
+    progress: Progress = Progress()
+    long_audio: LongAudio = LongAudio()
+    preprocessing: Preprocessing = Preprocessing()
+    transcript_cache: TranscriptCache = TranscriptCache()
+    chat_state: ChatState = ChatState()
 
     redis: Redis = Redis()
+    jobs: Jobs = Jobs()
+    webhook: Optional[Webhook] = None
+    metrics: Optional[Metrics] = None
     chat_id_permitted_list: list[int] = []
 
     class Config:
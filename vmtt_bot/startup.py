@@ -0,0 +1,37 @@
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+
+
+class StartupProfile:
+    """Durations of imports and initialization steps in the order they were started.
+
+    Steps may run concurrently, the total is the wall time since the profile was created.
+    """
+
+    def __init__(self) -> None:
+        self.started_at = time.perf_counter()
+        self.steps: list[tuple[str, float]] = []
+
+    @contextmanager
+    def measure(self, step: str) -> Iterator[None]:
+        index = len(self.steps)
+        self.steps.append((step, 0.0))
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.steps[index] = (step, time.perf_counter() - start)
+
+    @property
+    def total(self) -> float:
+        return time.perf_counter() - self.started_at
+
+    def report(self) -> str:
+        width = max((len(step) for step, _ in self.steps), default=0)
+        lines = [f'{step:<{width}}  {duration * 1000:8.1f} ms' for step, duration in self.steps]
+        lines.append(f'{"total":<{width}}  {self.total * 1000:8.1f} ms')
+        return '\n'.join(lines)
+
+
+profile = StartupProfile()
@@ -0,0 +1,67 @@
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import aioredis
+
+
+class TranscriptCache:
+    """Transcripts keyed by Telegram ``file_unique_id`` and recognition options.
+
+    Entries are stored in Redis with a TTL, an optional in-process LRU tier of ``local_size`` entries sits in front
+    of it. Redis failures are logged and treated as cache misses.
+    """
+
+    def __init__(self, redis: aioredis.Redis, ttl: int, local_size: int = 0, max_length: int = 16384,
+                 prefix: str = 'transcript') -> None:
+        self.__redis = redis
+        self.__ttl = ttl
+        self.__local_size = local_size
+        self.__max_length = max_length
+        self.__prefix = prefix
+        self.__local: OrderedDict[str, tuple[float, str]] = OrderedDict()
+
+    def get_key(self, file_unique_id: str, options: str) -> str:
+        options_hash = hashlib.sha1(options.encode()).hexdigest()[:16]
+        return f'{self.__prefix}:{file_unique_id}:{options_hash}'
+
+    async def get(self, file_unique_id: str, options: str) -> Optional[str]:
+        key = self.get_key(file_unique_id, options)
+        local = self.__local.get(key)
+        if local:
+            expires_at, text = local
+            if expires_at > time.monotonic():
+                self.__local.move_to_end(key)
+                return text
+            del self.__local[key]
+        try:
+            async with self.__redis.pipeline(transaction=False) as pipe:
+                pipe.get(key)
+                pipe.ttl(key)
+                text, ttl = await pipe.execute()
+        except aioredis.RedisError:
+            logging.exception('Transcript cache get error')
+            return None
+        if text is not None:
+            self.__store_local(key, text, ttl if ttl > 0 else self.__ttl)
+        return text
+
+    async def set(self, file_unique_id: str, options: str, text: str) -> None:
+        if len(text) > self.__max_length:
+            return
+        key = self.get_key(file_unique_id, options)
+        self.__store_local(key, text, self.__ttl)
+        try:
+            await self.__redis.set(key, text, ex=self.__ttl)
+        except aioredis.RedisError:
+            logging.exception('Transcript cache set error')
+
+    def __store_local(self, key: str, text: str, ttl: int) -> None:
+        if self.__local_size <= 0:
+            return
+        self.__local[key] = (time.monotonic() + ttl, text)
+        self.__local.move_to_end(key)
+        while len(self.__local) > self.__local_size:
+            self.__local.popitem(last=False)
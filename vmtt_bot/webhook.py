@@ -0,0 +1,90 @@
+import asyncio
+import hmac
+import logging
+import ssl
+from collections.abc import Awaitable, Callable
+from typing import Optional
+
+from aiogram import Bot, Dispatcher, types
+from aiogram.bot import api
+from aiohttp import web
+
+from vmtt_bot.settings import Webhook
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+SHUTDOWN_TIMEOUT = 30
+
+DispatcherCallback = Callable[[Dispatcher], Awaitable[None]]
+
+
+class WebhookHandler:
+    """Acknowledges updates right away and processes them in background tasks.
+
+    Replicas keep no state of their own, so any number of them can serve the same webhook behind a load balancer.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, secret_token: Optional[str] = None) -> None:
+        self.__dispatcher = dispatcher
+        self.__secret_token = secret_token
+        self.__tasks: set[asyncio.Task[None]] = set()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.__secret_token and not hmac.compare_digest(
+            request.headers.get(SECRET_TOKEN_HEADER, ''), self.__secret_token
+        ):
+            raise web.HTTPUnauthorized()
+        update = types.Update(**await request.json())
+        task = asyncio.create_task(self.__process(update))
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
+        return web.Response()
+
+    async def wait_closed(self, timeout: float = SHUTDOWN_TIMEOUT) -> None:
+        if not self.__tasks:
+            return
+        _, pending = await asyncio.wait(self.__tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+
+    async def __process(self, update: types.Update) -> None:
+        Bot.set_current(self.__dispatcher.bot)
+        Dispatcher.set_current(self.__dispatcher)
+        try:
+            await self.__dispatcher.process_update(update)
+        except Exception:
+            logging.exception('Update processing error')
+
+
+async def set_webhook(bot: Bot, webhook: Webhook) -> None:
+    payload = {'url': str(webhook.url)}
+    if webhook.secret_token:
+        payload['secret_token'] = webhook.secret_token
+    await bot.request(api.Methods.SET_WEBHOOK, payload)
+
+
+def start_webhook(dispatcher: Dispatcher, webhook: Webhook, on_startup: DispatcherCallback,
+                  on_shutdown: DispatcherCallback) -> None:
+    handler = WebhookHandler(dispatcher, webhook.secret_token)
+
+    async def app_startup(app: web.Application) -> None:
+        await on_startup(dispatcher)
+        if webhook.url:
+            await set_webhook(dispatcher.bot, webhook)
+
+    async def app_shutdown(app: web.Application) -> None:
+        await handler.wait_closed()
+        await on_shutdown(dispatcher)
+        session = await dispatcher.bot.get_session()
+        await session.close()
+
+    app = web.Application()
+    app.router.add_post(webhook.path, handler.handle)
+    app.on_startup.append(app_startup)
+    app.on_shutdown.append(app_shutdown)
+
+    ssl_context: Optional[ssl.SSLContext] = None
+    if webhook.ssl_certificate:
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(webhook.ssl_certificate, webhook.ssl_private_key)
+
+    web.run_app(app, host=webhook.host, port=webhook.port, ssl_context=ssl_context)
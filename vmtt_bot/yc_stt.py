@@ -1,21 +1,44 @@
-import io
-from collections.abc import Iterator
+import asyncio
+import logging
+import random
+import statistics
+import time
+from collections import OrderedDict, deque
+from collections.abc import AsyncIterable, AsyncIterator, Awaitable
+from contextlib import ExitStack
 from datetime import datetime, timezone, timedelta
-from typing import Optional
+from typing import TYPE_CHECKING, Any, NamedTuple, Optional
 
 from aiohttp import hdrs
 from yarl import URL
 
 import aiohttp
-import grpc
 from pydantic import BaseModel
 
-from vmtt_bot.settings import OAuth
-from yandex.cloud.ai.stt.v3 import stt_pb2, stt_service_pb2_grpc
+from vmtt_bot.audio_buffer import ReplayableAudio
+from vmtt_bot.iam import IamTokenCache
+from vmtt_bot.metrics import AUDIO_BYTES, GRPC_ERRORS, RECOGNITIONS_IN_FLIGHT, STAGE_DURATION
+from vmtt_bot.settings import IamCache, OAuth, ResourceManager, SpeechKit, YcEndpoints
+
+# grpc and the SpeechKit stubs take a while to import, they are imported by the first recognition or warm-up, so
+# processes which only authorize users never load them
+if TYPE_CHECKING:
+    import grpc
+
+    from vmtt_bot.channel_pool import ChannelPool, PooledChannel
+    from yandex.cloud.ai.stt.v3 import stt_pb2
 
-CHUNK_SIZE = 4000
 OAUTH_SERVER = URL('https://oauth.yandex.ru')
-YC_RESOURCE_MANAGER = URL('https://resource-manager.api.cloud.yandex.net/resource-manager/v1')
+HEDGE_MIN_SAMPLES = 20
+
+
+class RecognitionError(Exception):
+    pass
+
+
+class RecognitionUpdate(NamedTuple):
+    text: str
+    final: bool
 
 
 def to_camel(snake_str: str) -> str:
@@ -49,19 +72,82 @@ class OAuthTokenSuccessfulResponse(BaseModel):
 
 
 class YcStt:
-    def __init__(self, folder_id: str = None, oauth_token: str = None, oauth: OAuth = None) -> None:
+    def __init__(self, folder_id: str = None, oauth_token: str = None, oauth: OAuth = None,
+                 iam_cache: IamCache = IamCache(), resource_manager: ResourceManager = ResourceManager(),
+                 speechkit: SpeechKit = SpeechKit(), endpoints: YcEndpoints = YcEndpoints()) -> None:
         self.__session = aiohttp.ClientSession()
-        self.__channel = grpc.aio.secure_channel(
-            'stt.api.cloud.yandex.net:443', grpc.ssl_channel_credentials()
-        )
+        self.__channels: Optional[ChannelPool] = None
         self.__oauth_token = oauth_token
         self.__oauth = oauth
         self.__folder_id = folder_id
-        self.__iam_token: Optional[IamToken] = None
+        self.__endpoints = endpoints
+        self.__iam_tokens = IamTokenCache(
+            self.__fetch_iam_token,
+            max_size=iam_cache.max_size,
+            refresh_before=timedelta(seconds=iam_cache.refresh_before),
+        )
+        self.__resource_manager = resource_manager
+        self.__speechkit = speechkit
+        self.__first_response_times: deque[float] = deque(maxlen=200)
+        self.__folders_cache: OrderedDict[str, tuple[float, dict[str, str]]] = OrderedDict()
 
     async def close(self) -> None:
+        self.__iam_tokens.close()
         await self.__session.close()
-        await self.__channel.close()
+        if self.__channels:
+            await self.__channels.close()
+
+    @property
+    def channels_in_flight(self) -> list[int]:
+        return [channel.in_flight for channel in self.__channels.channels] if self.__channels else []
+
+    async def warm_up(self) -> None:
+        """Connect the SpeechKit channels and get the IAM token of the default credentials concurrently.
+
+        Without a default folder the default credentials are not used and their token is not requested. Failures
+        are logged only, the first recognition retries both.
+        """
+        async def connect() -> None:
+            channels = self.__get_channels()
+            await asyncio.gather(*(channel.channel.channel_ready() for channel in channels.channels))
+
+        steps: dict[str, Awaitable[Any]] = {'SpeechKit channels': connect()}
+        if self.__oauth_token or self.__folder_id:
+            # the IAM request goes first to be in flight while grpc is imported
+            steps = {'IAM token': self.__get_authorization(), **steps}
+        results = await asyncio.gather(
+            *(asyncio.wait_for(step, self.__speechkit.warm_up_timeout) for step in steps.values()),
+            return_exceptions=True,
+        )
+        for name, result in zip(steps, results):
+            if isinstance(result, BaseException):
+                logging.warning('%s warm-up failed: %r', name, result)
+
+    def __get_channels(self) -> 'ChannelPool':
+        if self.__channels is None:
+            import grpc
+
+            from vmtt_bot.channel_pool import ChannelPool
+
+            speechkit = self.__speechkit
+            self.__channels = ChannelPool(
+                speechkit.endpoint,
+                size=speechkit.channels,
+                selection=speechkit.channel_selection,
+                credentials=grpc.ssl_channel_credentials() if speechkit.secure else None,
+                options=[
+                    ('grpc.keepalive_time_ms', speechkit.keepalive_time_ms),
+                    ('grpc.keepalive_timeout_ms', speechkit.keepalive_timeout_ms),
+                    ('grpc.keepalive_permit_without_calls', 1),
+                    ('grpc.client_idle_timeout_ms', speechkit.idle_timeout_ms),
+                    ('grpc.max_send_message_length', speechkit.max_message_length),
+                    ('grpc.max_receive_message_length', speechkit.max_message_length),
+                ],
+            )
+        return self.__channels
+
+    def collect_channels_in_flight(self) -> dict[tuple[str, ...], float]:
+        return {(str(index),): in_flight for index, in_flight in enumerate(self.channels_in_flight)}
 
     def get_authorization_url(self, device_id: str, device_name: str, state: str = '') -> str:
         if not self.__oauth:
@@ -96,6 +182,8 @@ class YcStt:
     async def revoke_token(self, access_token: str) -> str:
         if not self.__oauth:
             raise Exception('OAuth not configured')
+        self.__iam_tokens.invalidate(access_token)
+        self.__folders_cache.pop(IamTokenCache.get_key(access_token), None)
         url = OAUTH_SERVER / 'revoke_token'
         data = {
             'access_token': access_token,
@@ -109,67 +197,160 @@ class YcStt:
             return response_data
 
     async def get_folders(self, yc_oauth_token: str) -> dict[str, str]:
-        headers = {
+        cache_key = IamTokenCache.get_key(yc_oauth_token)
+        cached = self.__folders_cache.get(cache_key)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+        headers: dict[str, str] = {
             hdrs.AUTHORIZATION: await self.__get_authorization(yc_oauth_token)
         }
-        async with self.__session.get(YC_RESOURCE_MANAGER / 'clouds', headers=headers) as response:
-            clouds_data = await response.json()
-            if response.status >= 400:
-                raise Exception(clouds_data)
+        clouds = await self.__list_resources('clouds', headers)
+        semaphore = asyncio.Semaphore(self.__resource_manager.concurrency)
+
+        async def list_folders(cloud_id: str) -> list[dict]:
+            async with semaphore:
+                return await self.__list_resources('folders', headers, {'cloudId': cloud_id})
+
+        clouds_folders = await asyncio.gather(*(list_folders(cloud['id']) for cloud in clouds))
         result: dict[str, str] = {}
-        if 'clouds' not in clouds_data:
-            return result
-        for cloud in clouds_data['clouds']:
-            async with self.__session.get(YC_RESOURCE_MANAGER / 'folders',
-                                          params={'cloudId': cloud['id']}, headers=headers) as response:
-                folders_data = await response.json()
-                if response.status >= 400:
-                    raise Exception(clouds_data)
-            if 'folders' not in folders_data:
-                continue
-            for folder in folders_data['folders']:
+        for cloud, folders in zip(clouds, clouds_folders):
+            for folder in folders:
                 result[folder['id']] = f'{cloud["name"]} - {folder["name"]}'
+        self.__folders_cache[cache_key] = (time.monotonic() + self.__resource_manager.cache_ttl, result)
+        self.__folders_cache.move_to_end(cache_key)
+        while len(self.__folders_cache) > self.__resource_manager.cache_size:
+            self.__folders_cache.popitem(last=False)
         return result
 
+    async def __list_resources(self, resource: str, headers: dict[str, str],
+                               params: Optional[dict[str, str]] = None) -> list[dict]:
+        url = URL(self.__endpoints.resource_manager) / resource
+        items: list[dict] = []
+        query = dict(params or {})
+        while True:
+            async with self.__session.get(url, params=query, headers=headers) as response:
+                data = await response.json()
+                if response.status >= 400:
+                    raise Exception(data)
+            items.extend(data.get(resource, []))
+            if not data.get('nextPageToken'):
+                return items
+            query['pageToken'] = data['nextPageToken']
+
     async def __get_authorization(self, yc_oauth_token: str = None) -> str:
-        def format_authorization() -> str:
-            return f'Bearer {self.__iam_token.iam_token}'
+        iam_token = await self.__iam_tokens.get(yc_oauth_token or self.__oauth_token)
+        return f'Bearer {iam_token.iam_token}'
 
-        now = datetime.now(timezone.utc)
-        if self.__iam_token and self.__iam_token.expires_at > now + timedelta(minutes=1):
-            return format_authorization()
-        oauth_token = yc_oauth_token or self.__oauth_token
+    async def __fetch_iam_token(self, oauth_token: Optional[str]) -> IamToken:
+        with STAGE_DURATION.time('iam_token'):
+            return await self.__request_iam_token(oauth_token)
+
+    async def __request_iam_token(self, oauth_token: Optional[str]) -> IamToken:
         if oauth_token:
             body = {'yandexPassportOauthToken': oauth_token}
-            async with self.__session.post(
-                'https://iam.api.cloud.yandex.net/iam/v1/tokens', json=body
-            ) as response:
-                response.raise_for_status()
-                data = await response.json()
-            self.__iam_token = IamToken.parse_obj(data)
-        else:
-            headers = {'Metadata-Flavor': 'Google'}
-            async with self.__session.get(
-                'http://169.254.169.254/computeMetadata/v1/instance/service-accounts/default/token', headers=headers
-            ) as response:
+            async with self.__session.post(self.__endpoints.iam_tokens, json=body) as response:
                 response.raise_for_status()
                 data = await response.json()
-            cmt = ComputeMetadataToken.parse_obj(data)
-            self.__iam_token = IamToken(
-                iam_token=cmt.access_token,
-                expires_at=now + timedelta(seconds=cmt.expires_in),
+            return IamToken.parse_obj(data)
+        now = datetime.now(timezone.utc)
+        headers = {'Metadata-Flavor': 'Google'}
+        async with self.__session.get(self.__endpoints.compute_metadata_token, headers=headers) as response:
+            response.raise_for_status()
+            data = await response.json()
+        cmt = ComputeMetadataToken.parse_obj(data)
+        return IamToken(
+            iam_token=cmt.access_token,
+            expires_at=now + timedelta(seconds=cmt.expires_in),
+        )
+
+    async def recognize(self, audio_chunks: AsyncIterable[bytes], audio: bool = False,
+                        yc_oauth_token: str = None, yc_folder_id: str = None,
+                        audio_format: Optional['stt_pb2.AudioFormatOptions'] = None) -> str:
+        parts: list[str] = []
+        async for update in self.recognize_stream(audio_chunks, audio, yc_oauth_token, yc_folder_id,
+                                                  audio_format=audio_format):
+            parts.append(update.text)
+        return ' '.join(parts)
+
+    async def recognize_stream(self, audio_chunks: AsyncIterable[bytes], audio: bool = False,
+                               yc_oauth_token: str = None, yc_folder_id: str = None,
+                               partials: bool = False,
+                               audio_format: Optional['stt_pb2.AudioFormatOptions'] = None,
+                               ) -> AsyncIterator[RecognitionUpdate]:
+        """Yield final utterances as they are recognized.
+
+        With ``partials`` the not yet finished utterance is yielded too, each partial update replaces the previous
+        one until the final update for the utterance arrives. Calls failed with a retryable status are repeated with
+        the audio replayed, utterances already yielded are not yielded again. At most ``replay_buffer_size`` bytes
+        of audio are kept for replays, calls of longer audio are neither retried nor hedged once it is exceeded.
+
+        The audio is MP3 if ``audio`` is set and OGG Opus otherwise, unless ``audio_format`` is given.
+        """
+        import grpc
+
+        from yandex.cloud.ai.stt.v3 import stt_pb2
+
+        if audio_format is None:
+            audio_format = stt_pb2.AudioFormatOptions(
+                container_audio=stt_pb2.ContainerAudio(
+                    container_audio_type=stt_pb2.ContainerAudio.MP3 if audio else stt_pb2.ContainerAudio.OGG_OPUS,
+                ),
             )
-        return format_authorization()
+        audio_source = ReplayableAudio(
+            audio_chunks, buffered=self.__speechkit.retry_attempts > 1 or self.__speechkit.hedging,
+            max_size=self.__speechkit.replay_buffer_size,
+        )
+        started_at = time.perf_counter()
+        delivered = 0
+        attempt = 0
+        RECOGNITIONS_IN_FLIGHT.inc()
+        try:
+            while True:
+                attempt += 1
+                skip = delivered
+                try:
+                    async for update in self.__recognize_attempt(audio_source, audio_format, yc_oauth_token,
+                                                                 yc_folder_id, partials):
+                        if skip:
+                            skip -= update.final
+                            continue
+                        delivered += update.final
+                        yield update
+                    break
+                except grpc.aio.AioRpcError as exc:
+                    GRPC_ERRORS.inc(exc.code().name)
+                    if (
+                        exc.code().name not in self.__speechkit.retry_status_codes
+                        or attempt >= self.__speechkit.retry_attempts
+                        or not audio_source.replayable
+                    ):
+                        raise RecognitionError(exc.details()) from exc
+                    backoff = min(
+                        self.__speechkit.retry_initial_backoff * self.__speechkit.retry_backoff_multiplier ** (
+                            attempt - 1
+                        ),
+                        self.__speechkit.retry_max_backoff,
+                    )
+                    backoff *= random.uniform(0.5, 1)
+                    logging.warning('Recognition attempt %s failed with %s, retry in %.2f s',
+                                    attempt, exc.code().name, backoff)
+                    await asyncio.sleep(backoff)
+        finally:
+            RECOGNITIONS_IN_FLIGHT.dec()
+            STAGE_DURATION.observe(time.perf_counter() - started_at, 'recognition')
+        if audio_source.error:
+            raise audio_source.error
+
+    async def __recognize_attempt(self, audio_source: ReplayableAudio, audio_format: 'stt_pb2.AudioFormatOptions',
+                                  yc_oauth_token: Optional[str], yc_folder_id: Optional[str],
+                                  partials: bool) -> AsyncIterator[RecognitionUpdate]:
+        import grpc
 
-    async def recognize(self, audio_file: io.BytesIO, audio: bool = False,
-                        yc_oauth_token: str = None, yc_folder_id: str = None) -> str:
-        def request_iterator() -> Iterator[stt_pb2.StreamingRequest]:
+        from yandex.cloud.ai.stt.v3 import stt_pb2, stt_service_pb2_grpc
+
+        async def request_iterator() -> AsyncIterator[stt_pb2.StreamingRequest]:
             recognition_model_options = stt_pb2.RecognitionModelOptions(
-                audio_format=stt_pb2.AudioFormatOptions(
-                    container_audio=stt_pb2.ContainerAudio(
-                        container_audio_type=stt_pb2.ContainerAudio.MP3 if audio else stt_pb2.ContainerAudio.OGG_OPUS,
-                    ),
-                ),
+                audio_format=audio_format,
                 text_normalization=stt_pb2.TextNormalizationOptions(
                     text_normalization=stt_pb2.TextNormalizationOptions.TEXT_NORMALIZATION_ENABLED,
                     literature_text=True,
@@ -178,23 +359,82 @@ class YcStt:
             streaming_options = stt_pb2.StreamingOptions(recognition_model=recognition_model_options)
             yield stt_pb2.StreamingRequest(session_options=streaming_options)
 
-            audio_file.seek(0)
-            data = audio_file.read(CHUNK_SIZE)
-            while data != b'':
+            # errors of the audio source are kept by ReplayableAudio, grpc would swallow them anyway
+            async for data in audio_source.read():
+                AUDIO_BYTES.inc(amount=len(data))
                 yield stt_pb2.StreamingRequest(chunk=stt_pb2.AudioChunk(data=data))
-                data = audio_file.read(CHUNK_SIZE)
 
-        stub = stt_service_pb2_grpc.RecognizerStub(self.__channel)
-        response_iterator = stub.RecognizeStreaming(request_iterator(), metadata=(
+        metadata = (
             ('authorization', await self.__get_authorization(yc_oauth_token)),
             ('x-folder-id', yc_folder_id or self.__folder_id),
-        ))
+        )
+        started_at = time.perf_counter()
+        calls: dict[asyncio.Future, grpc.aio.StreamStreamCall] = {}
+        # each call holds its channel until it is cancelled, a hedged call which lost doesn't count as in flight
+        channel_releases: dict[asyncio.Future, ExitStack] = {}
+        channels = self.__get_channels()
+
+        def start_call(exclude: Optional['PooledChannel'] = None) -> 'PooledChannel':
+            with ExitStack() as stack:
+                channel = stack.enter_context(channels.acquire(exclude))
+                stub = channel.get_stub(stt_service_pb2_grpc.RecognizerStub)
+                call = stub.RecognizeStreaming(request_iterator(), metadata=metadata,
+                                               timeout=self.__speechkit.deadline)
+                future = asyncio.ensure_future(call.read())
+                calls[future] = call
+                channel_releases[future] = stack.pop_all()
+            return channel
+
+        def cancel_call(future: asyncio.Future) -> None:
+            future.cancel()
+            calls[future].cancel()
+            release = channel_releases.pop(future, None)
+            if release:
+                release.close()
 
-        parts: list[str] = []
         try:
-            async for response in response_iterator:  # type: stt_pb2.StreamingResponse
+            channel = start_call()
+            if self.__speechkit.hedging and audio_source.replayable:
+                done, _ = await asyncio.wait(calls, timeout=self.__get_hedge_delay())
+                if not done:
+                    logging.info('No response in %.2f s, hedging recognition', time.perf_counter() - started_at)
+                    start_call(exclude=channel)
+            call, response = await self.__wait_first_response(calls)
+            for future, other_call in calls.items():
+                if other_call is not call:
+                    cancel_call(future)
+            first_response_time = time.perf_counter() - started_at
+            self.__first_response_times.append(first_response_time)
+            STAGE_DURATION.observe(first_response_time, 'first_response')
+            while response is not grpc.aio.EOF:
                 if response.HasField('final_refinement'):
-                    parts.append(response.final_refinement.normalized_text.alternatives[0].text)
-        except grpc.aio.AioRpcError as exc:
-            return exc.details()
-        return ' '.join(parts)
+                    yield RecognitionUpdate(response.final_refinement.normalized_text.alternatives[0].text, True)
+                elif partials and response.HasField('partial') and response.partial.alternatives:
+                    yield RecognitionUpdate(response.partial.alternatives[0].text, False)
+                response = await call.read()
+        finally:
+            for future in calls:
+                cancel_call(future)
+
+    @staticmethod
+    async def __wait_first_response(
+        calls: dict[asyncio.Future, 'grpc.aio.StreamStreamCall']
+    ) -> tuple['grpc.aio.StreamStreamCall', Any]:
+        pending = dict(calls)
+        failed: Optional[tuple['grpc.aio.StreamStreamCall', asyncio.Future]] = None
+        while True:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                call = pending.pop(future)
+                # a call is cancelled by grpc when its audio can't be replayed to it any more
+                if not future.cancelled() and future.exception() is None:
+                    return call, future.result()
+                if failed is None or failed[1].cancelled():
+                    failed = call, future
+                if not pending:
+                    return failed[0], failed[1].result()
+
+    def __get_hedge_delay(self) -> float:
+        if len(self.__first_response_times) < HEDGE_MIN_SAMPLES:
+            return self.__speechkit.hedge_after
+        return statistics.quantiles(self.__first_response_times, n=20)[-1]